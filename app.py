@@ -4,33 +4,54 @@ from scripts import tabledef
 from scripts import forms
 from scripts import helpers
 from scripts import version
+from scripts import training_queue
+from scripts import incremental_training
+from scripts import training_telemetry
+from scripts import log_broadcaster
+from scripts import log_archive
+from scripts import file_window
+from scripts import image_conversion
+from scripts import dataset_ingest
+from scripts import dataset_manifest
+from scripts import thumbnails
+from scripts import image_tiles
+from scripts import file_responses
+from scripts import queue_logging
 from flask import Flask, redirect, url_for, render_template, request, session, send_from_directory, Response, send_file, after_this_request
-from pygtail import Pygtail
 import json
 import sys
 import os
 import time
 import logging
-import logging.handlers
-import subprocess
 import urllib.parse
-from werkzeug.exceptions import HTTPException
+from werkzeug.exceptions import HTTPException, NotFound, RequestEntityTooLarge
 from pathlib import Path
 import shutil
 import zipfile
 import tempfile
 import werkzeug
 import datetime
-from threading import Thread
 try:
     import psutil
 except ImportError:
     psutil = None
 werkzeug.serving._log_add_style = False
 
+class UploadRequest(Flask.request_class):
+    """Spools uploaded images to helpers.LimitedUploadFile, so an oversize
+    one is cut off while the request is read and only that file is refused."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if filename and not dataset_ingest.is_archive(filename):
+            return helpers.LimitedUploadFile()
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
 app = Flask(__name__)
+app.request_class = UploadRequest
 
 app.secret_key = 'TesseractOcrTraining' # Generic key for dev purposes only
+# Larger requests are refused while they are read (413).
+app.config['MAX_CONTENT_LENGTH'] = helpers.MAX_UPLOAD_REQUEST_BYTES
 
 log_file_path = '/var/log/tesseracttraining/tesseracttraining.log'
 # Make version information available to all templates
@@ -42,16 +63,9 @@ def inject_version():
 logger =None 
 
 logger = logging.getLogger('MainProgram')
-file_handler = logging.handlers.RotatingFileHandler(log_file_path, maxBytes=2000000, backupCount=50)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-file_handler.setFormatter(formatter)
-
-file_handler.setLevel(logging.INFO)
-logger.addHandler(file_handler)
-logger.setLevel(logging.INFO)
+# Request threads only queue the records; a listener thread writes them.
+queue_logging.setup_queue_logging(logger, [queue_logging.SharedRotatingFileHandler(log_file_path)])
 helpers.logger = logger
-training_in_process = False    
-training_in_process_datetime =''
 
 
 def _read_proc_stat_cpu_times():
@@ -135,22 +149,31 @@ def _get_system_info():
 
 
 def _get_training_status_info():
-    global training_in_process_datetime
-    global training_in_process
-    started_at = training_in_process_datetime if training_in_process else None
-    minutes_ago = None
-    can_stop = False
-
-    if started_at:
-        elapsed_seconds = max((datetime.datetime.now() - started_at).total_seconds(), 0)
-        minutes_ago = int(elapsed_seconds // 60)
-        can_stop = elapsed_seconds >= 30 * 60
-
+    running_jobs = []
+    now = datetime.datetime.now()
+    for job in training_queue.get_running_jobs():
+        started_at = job.started_at
+        minutes_ago = None
+        can_stop = False
+        if started_at:
+            elapsed_seconds = max((now - started_at).total_seconds(), 0)
+            minutes_ago = int(elapsed_seconds // 60)
+            can_stop = elapsed_seconds >= 30 * 60
+        running_jobs.append({
+            'job': job,
+            'training_in_process_datetime': started_at,
+            'minutes_ago': minutes_ago,
+            'can_stop': can_stop,
+        })
+
+    runner_state = training_queue.get_runner_state()
     return {
-        'training_in_process': training_in_process,
-        'training_in_process_datetime': started_at,
-        'minutes_ago': minutes_ago,
-        'can_stop': can_stop,
+        'training_in_process': len(running_jobs) > 0,
+        'running_jobs': running_jobs,
+        'queued_jobs': training_queue.get_queued_jobs(),
+        'slot_count': training_queue.get_slot_count(),
+        'runner_state': runner_state,
+        'runner_online': training_queue.is_runner_online(runner_state),
     }
 
 
@@ -187,12 +210,14 @@ def page_not_found(e):
 @app.errorhandler(Exception)
 def handle_exception(e):
     path = request.path
+    # pass through HTTP errors (304, 404, 416 of the file routes)
+    if isinstance(e, HTTPException) and not isinstance(e, RequestEntityTooLarge):
+        return e
     if logger :
         logger.exception(e)
         logger.error('error path:' + path)
-    # pass through HTTP errors
-    # if isinstance(e, HTTPException):
-        # return e
+    if isinstance(e, RequestEntityTooLarge):
+        return render_template("500_generic.html", e=e), 413
 
     # now you're handling non-HTTP exceptions only
     return render_template("500_generic.html", e=e), 500
@@ -259,29 +284,38 @@ def system_info():
 
 @app.route('/stop_training', methods=['POST'])
 def stop_training():
-    global training_in_process
-
     if not session.get('logged_in'):
         return redirect(url_for('login'))
 
-    if not training_in_process:
-        return redirect(url_for('system_info', message='No training is currently in process.', status_type='is-warning'))
-
-    training_status = _get_training_status_info()
-    if not training_status['can_stop']:
-        return redirect(
-            url_for(
-                'system_info',
-                message='You have to wait at least 30 minutes to stop it, please wait and then refresh the page to Stop it.',
-                status_type='is-warning'
+    try:
+        job_id = int(request.form.get('job_id', ''))
+    except ValueError:
+        return redirect(url_for('system_info', message='No training job selected.', status_type='is-warning'))
+
+    job = training_queue.get_job(job_id)
+    if not job or job.status not in training_queue.ACTIVE_STATUSES:
+        return redirect(url_for('system_info', message='This training job is not in process.', status_type='is-warning'))
+
+    # Owners can withdraw their queued jobs at any time; everything else can
+    # only be stopped 30 minutes after it started.
+    if job.status == training_queue.STATUS_RUNNING or job.username != helpers.get_username():
+        started_at = job.started_at or job.created_at
+        if (datetime.datetime.now() - started_at).total_seconds() < 30 * 60:
+            return redirect(
+                url_for(
+                    'system_info',
+                    message='You have to wait at least 30 minutes to stop it, please wait and then refresh the page to Stop it.',
+                    status_type='is-warning'
+                )
             )
-        )
 
     if request.form.get('stop_confirmation', '').strip().lower() != 'stop':
         return redirect(url_for('system_info', message='Stop request cancelled. Type stop to continue.', status_type='is-warning'))
 
-    training_in_process = False
-    return redirect(url_for('system_info', message='training_in_process has been set to False.', status_type='is-success'))
+    if not training_queue.stop_job(job_id):
+        return redirect(url_for('system_info', message='This training job already finished.', status_type='is-warning'))
+    logger.info('%s stopped training job %s' % (helpers.get_username(), job_id))
+    return redirect(url_for('system_info', message='Training job %s has been stopped, its training processes are terminated within a few seconds.' % job_id, status_type='is-success'))
 
 
 # -------- Signup ---------------------------------------------------------- #
@@ -389,19 +423,39 @@ def settings():
 
 # -------- images --------------- #
 @app.route('/images', methods=['GET', 'POST'])
-def images():
+def images(message=''):
     try:
         if session.get('logged_in'):
             user = helpers.get_user()
             # list, get bitmap and linked text file
-            filepairs = helpers.list_folder_image_text_pair(user.username )
-            return render_template('images.html', user=user, filepairs = filepairs)
+            page_args = _images_page_args()
+            filepairs, next_cursor = helpers.list_image_text_page(user.username, **page_args)
+            conversions = image_conversion.list_conversions(helpers.generate_image_folder(user.username))
+            return render_template('images.html', user=user, filepairs = filepairs, conversions = conversions, error = message,
+                                   prefix = page_args['prefix'], text_filter = page_args['text_filter'], next_cursor = next_cursor)
         logger.info("did not login forward to login")       
         return redirect(url_for('login'))
     except Exception as e :
         if logger :
             logger.exception(e)
 
+def _images_page_args():
+    """Arguments of helpers.list_image_text_page from ?after=&prefix=&filter=&limit="""
+    return {
+        'after': request.args.get('after', ''),
+        'prefix': request.args.get('prefix', ''),
+        'text_filter': request.args.get('filter', ''),
+        'limit': request.args.get('limit', helpers.IMAGES_PAGE_SIZE, type=int),
+    }
+
+@app.route('/api/images')
+def api_images():
+    """One page of the user's images; ?after=<next of the previous page> for the following one"""
+    if not session.get('logged_in'):
+        return {"error": "login required"}, 401
+    rows, next_cursor = helpers.list_image_text_page(helpers.get_username(), **_images_page_args())
+    return {"columns": ["image", "text_file", "text"], "rows": rows, "next": next_cursor}
+
 @app.route('/images/download_all_zip', methods=['GET'])
 def download_all_zip():
     """Download all files in user's root image folder (no subfolders) as a zip."""
@@ -411,7 +465,7 @@ def download_all_zip():
             user_folder = helpers.generate_image_folder(username)
             logger.info("download_all_zip: " + user_folder)
             zip_basename = f"{username}_images.zip"
-            fd, zip_path = tempfile.mkstemp(suffix=".zip", prefix=f"{username}_", dir=user_folder)
+            fd, zip_path = tempfile.mkstemp(suffix=".zip", prefix=f"{username}_", dir=dataset_manifest.scratch_folder(user_folder))
             os.close(fd)
             try:
                 with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
@@ -478,78 +532,115 @@ def imagefiles(name):
     # print('imagefile%s'%name)
     if session.get('logged_in'):
         username = helpers.get_username()
-        return send_from_directory(helpers.generate_image_folder(username), name)
+        folder = helpers.generate_image_folder(username)
+        return file_responses.send_user_file(folder, name, file_responses.USER_FILE_CACHE_CONTROL, hashed=True)
     logger.info("imagefiles did not login forward to login")       
     return redirect(url_for('login'))
+
+@app.route('/thumbnails/<name>')
+def thumbnail(name):
+    """Small png of the image <name>, see thumbnails"""
+    if session.get('logged_in'):
+        thumbnail_path = thumbnails.get_thumbnail(helpers.get_username(), name)
+        if not thumbnail_path:
+            return render_template('404.html'), 404
+        return file_responses.send_user_file(*os.path.split(thumbnail_path), file_responses.USER_FILE_CACHE_CONTROL)
+    return redirect(url_for('login'))
         
+def resolve_user_file(username, name, filename_with_path):
+    """(folder, file name) of ?path=<filename_with_path> inside the user's folder.
+
+    Raises NotFound for anything outside the folder, also through .. or symlinks.
+    """
+    result_folder = helpers.generate_image_folder(username)
+    filename_with_path_unquoted = urllib.parse.unquote_plus(filename_with_path or '')
+    path_part, filenamePart = os.path.split(filename_with_path_unquoted)
+    real_folder = os.path.join(result_folder, path_part)
+
+    path_real_folder = Path(os.path.realpath(real_folder))
+    path_result_folder = Path(os.path.realpath(result_folder))
+    if filenamePart and ((not path_part) or path_part == "." or path_real_folder == path_result_folder or path_result_folder in path_real_folder.parents) :
+        return real_folder, filenamePart
+    raise NotFound("Unknow file name: %s/%s"%(name, filename_with_path_unquoted) )
+
 @app.route('/download/<name>')
 def download(name):
     # print('result: %s'%name)
     if session.get('logged_in'):
         username = helpers.get_username()
-        result_folder = helpers.generate_image_folder(username)
-        filename_with_path = request.args.get("path")
-        filename_with_path_unquoted = urllib.parse.unquote_plus(filename_with_path)
-        path_part, filenamePart = os.path.split(filename_with_path_unquoted)
- 
-        real_folder = os.path.join( result_folder, path_part)
-        
-        path_real_folder = Path(real_folder)
-        path_result_folder = Path(result_folder)
-        if (not path_part ) or path_part == "." or path_result_folder in path_real_folder.parents :
-            # print ('%s    %s'%(real_folder, name) )
-            return send_from_directory(real_folder, filenamePart)
-        else :
-            raise Exception("Unknow file name: %s/%s"%(name, filename_with_path_unquoted) )
+        real_folder, filenamePart = resolve_user_file(username, name, request.args.get("path"))
+        return file_responses.send_user_file(real_folder, filenamePart, file_responses.USER_FILE_CACHE_CONTROL)
     # print("resultfiles did not login forward to login")       
     logger.info("resultfiles did not login forward to login")       
     return redirect(url_for('login'))
 
+LOG_VIEW_LINES = 2000
+LOG_VIEW_MAX_LINES = 20000
+VIEWABLE_EXTENSIONS = ['.txt', '.log', '.md', '.py', '.html', '.css', '.js', '.json', '.xml', '.csv']
+
 @app.route('/view/<name>')
 def view_file(name):
-    """View text file content in browser"""
+    """View text file content in browser, one window of the file at a time"""
     if session.get('logged_in'):
         username = helpers.get_username()
-        result_folder = helpers.generate_image_folder(username)
         filename_with_path = request.args.get("path")
-        filename_with_path_unquoted = urllib.parse.unquote_plus(filename_with_path)
-        path_part, filenamePart = os.path.split(filename_with_path_unquoted)
-        real_folder = os.path.join(result_folder, path_part)
-        
-        path_real_folder = Path(real_folder)
-        path_result_folder = Path(result_folder)
-        if (not path_part) or path_part == "." or path_result_folder in path_real_folder.parents:
-            file_path = os.path.join(real_folder, filenamePart)
-            
-            # Check if file exists and is a text file
-            if os.path.exists(file_path):
-                _, ext = os.path.splitext(filenamePart.lower())
-                if ext in ['.txt', '.log', '.md', '.py', '.html', '.css', '.js', '.json', '.xml', '.csv']:
-                    try:
-                        with open(file_path, 'r', encoding='utf-8') as f:
-                            content = f.read()
-                        return render_template('file_viewer.html', 
-                                             filename=filenamePart, 
-                                             content=content,
-                                             file_type=ext[1:] if ext else 'text')
-                    except UnicodeDecodeError:
-                        # If UTF-8 fails, try with different encoding
-                        try:
-                            with open(file_path, 'r', encoding='latin-1') as f:
-                                content = f.read()
-                            return render_template('file_viewer.html', 
-                                                 filename=filenamePart, 
-                                                 content=content,
-                                                 file_type=ext[1:] if ext else 'text')
-                        except Exception as e:
-                            return f"Error reading file: {str(e)}", 500
-                else:
-                    # For non-text files, redirect to download
-                    return redirect(url_for('download', name=name, path=filename_with_path))
+        real_folder, filenamePart = resolve_user_file(username, name, filename_with_path)
+        file_path = os.path.join(real_folder, filenamePart)
+        tail = request.args.get('tail') == '1'
+
+        def window_url(**args):
+            return url_for('view_file', name=name, path=filename_with_path, **args)
+
+        # Archived logs are read by lines, through their index.
+        log_path = log_archive.original_path(file_path)
+        if filenamePart.lower().endswith('.log' + log_archive.ARCHIVE_SUFFIX) and log_archive.is_archived(log_path):
+            line_count = min(max(1, request.args.get('lines', LOG_VIEW_LINES, type=int)), LOG_VIEW_MAX_LINES)
+            if tail:
+                lines, total_lines = log_archive.read_archived_tail(log_path, line_count)
+                start = max(0, total_lines - line_count)
+            else:
+                start = max(0, request.args.get('start', 0, type=int))
+                lines, total_lines = log_archive.read_archived_lines(log_path, start, line_count)
+            window = {
+                'label': 'Lines %s-%s of %s' % (min(start + 1, total_lines), min(start + line_count, total_lines), total_lines),
+                'first_url': window_url(lines=line_count) if start > 0 else None,
+                'previous_url': window_url(start=max(0, start - line_count), lines=line_count) if start > 0 else None,
+                'next_url': window_url(start=start + line_count, lines=line_count) if start + line_count < total_lines else None,
+                'tail_url': window_url(tail=1, lines=line_count) if start + line_count < total_lines else None,
+            }
+            return render_template('file_viewer.html',
+                                 filename=filenamePart,
+                                 content='\n'.join(lines),
+                                 file_type='log',
+                                 window=window)
+
+        # Check if file exists and is a text file
+        if os.path.exists(file_path):
+            _, ext = os.path.splitext(filenamePart.lower())
+            if ext in VIEWABLE_EXTENSIONS:
+                # Only the requested window is read, whatever the file size.
+                length = request.args.get('length', file_window.VIEW_WINDOW_BYTES, type=int)
+                content, start, end, size = file_window.read_text_window(
+                    file_path, request.args.get('offset', 0, type=int), length, tail, request.args.get('align') == '1')
+                window = None
+                if start > 0 or end < size:
+                    window = {
+                        'label': 'Bytes %s-%s of %s' % (start, end, size),
+                        'first_url': window_url(length=length) if start > 0 else None,
+                        'previous_url': window_url(offset=max(0, start - length), length=length, align=1) if start > 0 else None,
+                        'next_url': window_url(offset=end, length=length) if end < size else None,
+                        'tail_url': window_url(tail=1, length=length) if end < size else None,
+                    }
+                return render_template('file_viewer.html', 
+                                     filename=filenamePart, 
+                                     content=content,
+                                     file_type=ext[1:] if ext else 'text',
+                                     window=window)
             else:
-                return "File not found", 404
+                # For non-text files, redirect to download
+                return redirect(url_for('download', name=name, path=filename_with_path))
         else:
-            raise Exception("Unknown file name: %s/%s" % (name, filename_with_path_unquoted))
+            return "File not found", 404
     
     logger.info("view_file did not login forward to login")
     return redirect(url_for('login'))
@@ -575,6 +666,8 @@ def logs():
         # list the content in logs folder, and for download
         folder_type =  'logs' 
         results = helpers.list_folder_result(user.username, folder_type  )
+        # The line index of an archived log is not for the user.
+        results = [r for r in results if not r[1].endswith(log_archive.INDEX_SUFFIX)]
         return render_template('files_for_display.html', results=results, folder_type =folder_type)
     logger.info("results did not login forward to login")       
     return redirect(url_for('login'))
@@ -586,7 +679,7 @@ def forum_image(username, filename):
     """Serve forum images - accessible to everyone"""
     try:
         forum_image_folder = helpers.generate_forum_image_folder(username)
-        return send_from_directory(forum_image_folder, filename)
+        return file_responses.send_user_file(forum_image_folder, filename, file_responses.FORUM_IMAGE_CACHE_CONTROL)
     except Exception as e:
         if logger:
             logger.exception(e)
@@ -602,7 +695,7 @@ def forum_image_by_post(post_id):
                 return render_template('404.html'), 404
             
             forum_image_folder = helpers.generate_forum_image_folder(post.author.username)
-            return send_from_directory(forum_image_folder, post.image_filename)
+            return file_responses.send_user_file(forum_image_folder, post.image_filename, file_responses.FORUM_IMAGE_CACHE_CONTROL)
     except Exception as e:
         if logger:
             logger.exception(e)
@@ -936,10 +1029,19 @@ def upload():
             files = request.files.getlist("fileupload")
             
             # fileitem = request.files['fileupload']
+            messages = []
             for file in files:
-                e = helpers.save_image_file(user.username, file)
+                try :
+                    if dataset_ingest.is_archive(file.filename):
+                        messages.append(dataset_ingest.ingest_archive(user.username, file))
+                    else:
+                        e = helpers.save_image_file(user.username, file)
+                except RequestEntityTooLarge as e :
+                    # only this file is refused, the others are stored
+                    logger.warning('upload skipped: %s' % e.description)
+                    messages.append('skipped: %s' % e.description)
                 
-            return images()
+            return images(message='; '.join(messages))
         logger.info("upload did not login forward to login")       
         return redirect(url_for('login'))
     except Exception as e :
@@ -949,7 +1051,7 @@ def upload():
 
 # -------- training --------------- #
 @app.route('/training', methods=['GET'])
-def training():
+def training(message=''):
     try:
         if session.get('logged_in'):
             user = helpers.get_user()
@@ -957,12 +1059,21 @@ def training():
             filepairs = helpers.list_folder_image_text_pair(user.username)
             message_is_running=''
             enable_disable =''
-            if  training_in_process :
-                message_is_running ="Another user is running the training, can only one user can use it at the same time, please visit SystemInfo page to check if you can stop it"
-                enable_disable ='disabled'
+            running_jobs = training_queue.get_running_jobs()
+            queued_jobs = training_queue.get_queued_jobs()
+            slot_count = training_queue.get_slot_count()
+            if not training_queue.is_runner_online() :
+                message_is_running ="The training runner is not running at the moment, your job will wait in the queue until it is started again"
+            elif len(running_jobs) >= slot_count :
+                message_is_running ="All %s training slots are busy and %s job(s) are waiting. Your job will be queued and started automatically, see SystemInfo page for the queue" % (slot_count, len(queued_jobs))
+            if message :
+                message_is_running = message
             return render_template(
                 'training.html',
                 templates=start_templates,
+                previous_results=incremental_training.list_previous_results(user.username),
+                default_replay_percent=incremental_training.DEFAULT_REPLAY_PERCENT,
+                max_early_stop_checkpoints=training_telemetry.MAX_EARLY_STOP_CHECKPOINTS,
                 filepairs=filepairs,
                 message_is_running=message_is_running,
                 enable_disable=enable_disable
@@ -974,43 +1085,6 @@ def training():
             logger.exception(e)
         return handle_exception(e)
 
-def threaded_function_start_training(args):
-    global training_in_process
-    global training_in_process_datetime
-    try :
-
-        (is_validate_command, command_list, logfilename ) =args
-        logger.info ('In threaded_function_start_training: %s' % command_list)
-        with  open(logfilename, 'a', encoding="utf-8")  as the_logfile  :
-            try :
-                if training_in_process :
-                    raise Exception( 'Another training already in process')
-                training_in_process = True
-                training_in_process_datetime = datetime.datetime.now()
-                the_logfile.write( command_list)
-                the_logfile.write('\n\t\n\t\nThere is possible the log failed to refresh in middle, please do not refresh,\n but go Menu Logs to see the logs\n\t\n\t\n')
- 
-                the_logfile.flush()
-                if is_validate_command :
-                    # command_list ="dir && ping -t localhost"
-                    p = subprocess.Popen(command_list, stdout=the_logfile, stderr=subprocess.STDOUT, shell=True)
-                    p.wait()
-                the_logfile.flush()
-                the_logfile.write('\n\nCompleted: %s'%logfilename)
-                training_in_process =False
-            except Exception as e :
-                training_in_process = False
-                the_logfile.write(str(e))
-                the_logfile.flush()
-                if logger :
-                    logger.exception(e)            
-    except Exception as e2 :
-        if logger :
-            logger.exception(e2)     
-    finally :
-        training_in_process =False
-        pass
-
 # -------- start_training --------------- #
 @app.route('/start_training', methods=['POST'])
 def start_training():
@@ -1025,40 +1099,40 @@ def start_training():
                 pass
             model_name = request.form['model_name']
             more_parameters = request.form['more_parameters']
+            continue_from = request.form.get('continue_from', '').strip()
+            if continue_from and continue_from not in incremental_training.list_previous_results(user.username) :
+                # checked here, before the job takes a slot
+                logger.warning('%s cannot continue from %s' % (user.username, continue_from))
+                return training(message='%s is not one of your trained models, choose another one to continue from' % continue_from)
+            replay_percent = None
+            if continue_from :
+                try :
+                    replay_percent = max(0, min(100, int(request.form.get('replay_percent', ''))))
+                except ValueError :
+                    replay_percent = incremental_training.DEFAULT_REPLAY_PERCENT
+            early_stop_checkpoints = None
+            try :
+                early_stop_checkpoints = max(1, min(training_telemetry.MAX_EARLY_STOP_CHECKPOINTS,
+                                                    int(request.form.get('early_stop_checkpoints', ''))))
+            except ValueError :
+                pass
     #        helpers.start_training_process(user.username, start_template)
             session["start_template"]=start_template
             session["model_name"]=model_name
             session["more_parameters"]=more_parameters
             
+            log_filename_only = ''
+            job_id = None
             if model_name :
                 username = helpers.get_username()
                 model_name = model_name.strip()
-                start_model_string =''
-                if  len(start_template ) >0 :
-                    start_model_string = " START_MODEL=" + start_template
-                result_dir = helpers.generate_result_folder(username, "results")
-                ground_truth_dir = helpers.generate_image_folder(username)
-                result_dir_model = os.path.join(result_dir, model_name)
-                if os.path.exists(result_dir_model) :
-                    new_path = result_dir_model + '_'+ datetime.datetime.utcnow().strftime('%Y%m%d_%H%M%S%f')
-                    shutil.move(result_dir_model, new_path) 
-                if os.path.exists(result_dir_model +'.traineddata') :
-                    new_path_2= result_dir_model+'.traineddata' + '_'+ datetime.datetime.utcnow().strftime('%Y%m%d_%H%M%S%f')
-                    shutil.move(result_dir_model +'.traineddata', new_path_2) 
-                copy_command_1 ='mv -v ./data/%s %s' %(model_name, result_dir ) 
-                copy_command_2 ='mv -v ./data/%s.traineddata %s' %(model_name, result_dir ) 
-                copy_command = copy_command_1 +  ' &&  ' +  copy_command_2
-                command_list = 'cd /usr/local/src/tesstrain  && rm  -d -r -f data   && mkdir data && ' \
-                       + 'make training TESSDATA=/usr/local/src/tesstrain/tessdata_best DATA_DIR=/usr/local/src/tesstrain/data MODEL_NAME=%s %s GROUND_TRUTH_DIR=%s %s'%(model_name, start_model_string, ground_truth_dir, more_parameters) + ' && ' +copy_command
-                is_validate_command = True
-                (logfilename, log_filename_only)= helpers.get_current_log_name(username)
-                session["logfilename"]=logfilename
-                thread = Thread(target = threaded_function_start_training, args= ((is_validate_command, command_list, logfilename ),)  )
-                thread.start()
+                job = training_queue.enqueue_job(username, model_name, start_template, more_parameters, continue_from, replay_percent, early_stop_checkpoints)
+                log_filename_only = os.path.basename(job.log_filename)
+                session["logfilename"]=job.log_filename
+                session["training_job_id"]=job.id
+                job_id = job.id
         
-            
-            
-            return render_template('training_in_process.html', start_template=model_name, logfilename =log_filename_only)
+            return render_template('training_in_process.html', start_template=model_name, logfilename =log_filename_only, job_id=job_id)
         logger.info("start_training did not login forward to login")       
         return redirect(url_for('login'))    
     except Exception as e :
@@ -1067,6 +1141,21 @@ def start_training():
             logger.exception(e)
         return handle_exception(e)
 
+# Seconds between database checks whether the streamed job is still active.
+STREAM_STATUS_CHECK_SECONDS = 5
+
+def _job_finished_check(job_id):
+    """is_finished callback for LogTailer, asking the database at most every STREAM_STATUS_CHECK_SECONDS."""
+    state = {'checked_at': 0, 'finished': False}
+    def is_finished():
+        now = time.monotonic()
+        if not state['finished'] and now - state['checked_at'] >= STREAM_STATUS_CHECK_SECONDS:
+            state['checked_at'] = now
+            job = training_queue.get_job(job_id)
+            state['finished'] = job is None or job.status not in training_queue.ACTIVE_STATUSES
+        return state['finished']
+    return is_finished
+
 @app.route('/stream')
 def stream():
     try :
@@ -1080,11 +1169,38 @@ def stream():
                 logger.error('not find log filename  ')
                 return redirect(url_for('login'))   
              # print(command_list)
+            # Follow the log until the job is over; without a job, send what
+            # is there.
+            is_finished = None
+            job_id = session.get('training_job_id')
+            if job_id :
+                is_finished = _job_finished_check(job_id)
              
+            # Event ids are byte offsets in the log; a reconnecting browser
+            # sends the last one and continues right after it.
+            resume_offset = 0
+            try :
+                resume_offset = max(0, int(request.headers.get('Last-Event-ID', '0')))
+            except ValueError :
+                pass
+            if log_archive.is_archived(logfilename) :
+                # Finished and archived meanwhile, nothing to follow.
+                subscription = log_archive.iter_archived_chunks(logfilename, resume_offset)
+            else :
+                # All tabs following this log share one reader.
+                subscription = log_broadcaster.subscribe(logfilename, is_finished=is_finished, offset=resume_offset)
+
             def generate():
-                for line in Pygtail(logfilename, every_n=1):
-                    yield "data:" + str(line) + "\n\n"
-                    time.sleep(0.1) 
+                # One event per batch of lines, each line in its own data field.
+                for offset, text in subscription:
+                    if text is None :
+                        yield ": keep-alive\n\n"
+                        continue
+                    yield "id:%s\n" % offset + "".join("data:" + line + "\n" for line in text.splitlines()) + "\n"
+                if getattr(subscription, 'dropped', False) :
+                    # Too slow to keep up; ending without close makes the
+                    # browser reconnect and resume from the last id.
+                    return
 
                 yield  "data:" + 'close' + "\n\n" + "\n\n"
                 
@@ -1097,6 +1213,65 @@ def stream():
         return handle_exception(e)
     
 
+# -------- training telemetry --------------- #
+TELEMETRY_STREAM_INTERVAL_SECONDS = 5
+
+def _get_own_training_job(job_id):
+    job = training_queue.get_job(job_id)
+    if job and job.username == helpers.get_username():
+        return job
+    return None
+
+def _telemetry_response(job, after_iteration=None):
+    path = training_telemetry.generate_telemetry_path(job.username, job.id)
+    telemetry = training_telemetry.read_telemetry(path) or training_telemetry.new_telemetry(job.id)
+    result = training_telemetry.select_since(telemetry, after_iteration)
+    result = dict(result, status=job.status)
+    result.pop('offset', None)
+    return result
+
+@app.route('/api/training/<int:job_id>/telemetry')
+def training_telemetry_json(job_id):
+    """Telemetry of a training job; ?after=<iteration> returns only newer points"""
+    if not session.get('logged_in'):
+        return {"error": "login required"}, 401
+    job = _get_own_training_job(job_id)
+    if not job:
+        return {"error": "training job not found"}, 404
+    return _telemetry_response(job, request.args.get('after', type=int))
+
+@app.route('/api/training/<int:job_id>/telemetry/stream')
+def training_telemetry_stream(job_id):
+    """Telemetry as server-sent events, new points batched every few seconds"""
+    if not session.get('logged_in'):
+        return {"error": "login required"}, 401
+    job = _get_own_training_job(job_id)
+    if not job:
+        return {"error": "training job not found"}, 404
+
+    def generate():
+        after_iteration = None
+        last_updated = None
+        while True:
+            # Status first: once it is final, the runner has written the
+            # last telemetry.
+            job = training_queue.get_job(job_id)
+            result = _telemetry_response(job, after_iteration)
+            if result['updated_at'] != last_updated or job.status not in training_queue.ACTIVE_STATUSES:
+                last_updated = result['updated_at']
+                if result['points']:
+                    after_iteration = result['points'][-1][1]
+                yield 'event: telemetry\ndata: %s\n\n' % json.dumps(result, separators=(',', ':'))
+            else:
+                yield ': keep-alive\n\n'
+            if job.status not in training_queue.ACTIVE_STATUSES:
+                yield 'event: close\ndata: %s\n\n' % job.status
+                return
+            time.sleep(TELEMETRY_STREAM_INTERVAL_SECONDS)
+
+    return Response(generate(), mimetype='text/event-stream')
+
+
 @app.route('/imageedit', methods=['GET'])
 def imageedit():
     try:
@@ -1107,8 +1282,10 @@ def imageedit():
             image_full_path_url = filename
             #print(filename)
             current_text = helpers.read_image_text(user.username, filename)
+            # large page scans are shown as tiles, see image_tiles
+            tiles = image_tiles.get_pyramid(user.username, filename)
             return render_template('imageedit.html', image_full_path=image_full_path_url
-                    , image_path=filename, current_text=current_text)
+                    , image_path=filename, current_text=current_text, tiles=tiles)
         logger.info("imageedit did not login forward to login")       
         return redirect(url_for('login'))    
     except Exception as e :
@@ -1116,6 +1293,16 @@ def imageedit():
             logger.exception(e)
         return handle_exception(e)
 
+@app.route('/tiles/<key>/<int:level>/<int:column>_<int:row>.png')
+def tile(key, level, column, row):
+    """A tile of an image opened in the editor; the tiles of a key never change"""
+    if session.get('logged_in'):
+        tile_path = image_tiles.get_tile_path(helpers.get_username(), key, level, column, row)
+        if not tile_path:
+            return render_template('404.html'), 404
+        return file_responses.send_user_file(*os.path.split(tile_path), file_responses.TILE_CACHE_CONTROL)
+    return redirect(url_for('login'))
+
 @app.route('/savetext', methods=['GET', 'POST' ])
 def savetext():
     try:
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+Asynchronous (ASGI) entry point, an alternative to gunicorn app:app:
+
+    uvicorn asgi:application --workers 2
+
+Long-lived responses are served on the asyncio event loop, where a waiting
+client is a suspended coroutine instead of a blocked worker:
+
+- /stream (the training log) and /api/training/<id>/telemetry/stream
+- /download/<name> and /imagefiles/<name>
+
+Everything else, and every case these handlers leave alone (not logged in,
+unknown file, range and date conditional requests), goes to the Flask app,
+each request in its own thread. The file handlers send the same ETag and
+Cache-Control as the Flask views (see file_responses) and answer a matching
+If-None-Match with 304 themselves.
+"""
+
+import asyncio
+import json
+import mimetypes
+import os
+import re
+from email.utils import formatdate
+from urllib.parse import parse_qs
+
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.security import safe_join
+from werkzeug.wrappers import Request
+
+import app as flask_app
+from scripts import async_log_broadcaster
+from scripts import file_responses
+from scripts import helpers
+from scripts import training_queue
+
+logger = flask_app.logger
+
+FILE_CHUNK_BYTES = 256 * 1024
+
+_wsgi_application = WsgiToAsgi(flask_app.app)
+
+
+async def _run_in_executor(function, *args):
+    return await asyncio.get_event_loop().run_in_executor(None, function, *args)
+
+
+async def call_flask(scope, receive, send):
+    # asgiref runs all sync code in one shared thread unless each request
+    # has its own context.
+    async with ThreadSensitiveContext():
+        await _wsgi_application(scope, receive, send)
+
+
+def get_headers(scope):
+    return dict((name.decode('latin-1').lower(), value.decode('latin-1')) for (name, value) in scope['headers'])
+
+
+def load_session(headers):
+    """The Flask session of the request, read from its cookie."""
+    request = Request({'HTTP_COOKIE': headers.get('cookie', '')})
+    return flask_app.app.session_interface.open_session(flask_app.app, request) or {}
+
+
+async def start_response(send, status, headers):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.encode('latin-1'), str(value).encode('latin-1')) for (name, value) in headers],
+    })
+
+
+async def send_body(send, body, more_body=True):
+    await send({'type': 'http.response.body', 'body': body, 'more_body': more_body})
+
+
+async def watch_disconnect(receive, disconnected):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            disconnected.set()
+            return
+
+
+async def send_event_stream(receive, send, events):
+    """Send the strings of the async iterator events as text/event-stream until the client goes away."""
+    disconnected = asyncio.Event()
+    watcher = asyncio.ensure_future(watch_disconnect(receive, disconnected))
+    try:
+        await start_response(send, 200, [('content-type', 'text/event-stream'), ('cache-control', 'no-cache')])
+        async for event in events:
+            if disconnected.is_set():
+                break
+            await send_body(send, event.encode('utf-8'))
+        if not disconnected.is_set():
+            await send_body(send, b'', more_body=False)
+    finally:
+        watcher.cancel()
+        await events.aclose()
+
+
+async def log_events(subscription):
+    """Same events as the Flask /stream view."""
+    chunks = subscription.__aiter__()
+    try:
+        async for offset, text in chunks:
+            if text is None:
+                yield ": keep-alive\n\n"
+                continue
+            yield "id:%s\n" % offset + "".join("data:" + line + "\n" for line in text.splitlines()) + "\n"
+    finally:
+        # Unsubscribes right away instead of whenever it is collected.
+        await chunks.aclose()
+    if not subscription.dropped:
+        yield "data:" + 'close' + "\n\n" + "\n\n"
+
+
+async def stream(scope, receive, send, headers, session):
+    logfilename = session.get('logfilename')
+    if not logfilename or not os.path.isfile(logfilename):
+        return await call_flask(scope, receive, send)
+    is_finished = None
+    job_id = session.get('training_job_id')
+    if job_id:
+        is_finished = flask_app._job_finished_check(job_id)
+    resume_offset = 0
+    try:
+        resume_offset = max(0, int(headers.get('last-event-id', '0')))
+    except ValueError:
+        pass
+    subscription = await async_log_broadcaster.subscribe(logfilename, is_finished=is_finished, offset=resume_offset)
+    await send_event_stream(receive, send, log_events(subscription))
+
+
+async def telemetry_events(job_id):
+    """Same events as the Flask telemetry stream view."""
+    after_iteration = None
+    last_updated = None
+    while True:
+        job = await _run_in_executor(training_queue.get_job, job_id)
+        result = await _run_in_executor(flask_app._telemetry_response, job, after_iteration)
+        if result['updated_at'] != last_updated or job.status not in training_queue.ACTIVE_STATUSES:
+            last_updated = result['updated_at']
+            if result['points']:
+                after_iteration = result['points'][-1][1]
+            yield 'event: telemetry\ndata: %s\n\n' % json.dumps(result, separators=(',', ':'))
+        else:
+            yield ': keep-alive\n\n'
+        if job.status not in training_queue.ACTIVE_STATUSES:
+            yield 'event: close\ndata: %s\n\n' % job.status
+            return
+        await asyncio.sleep(flask_app.TELEMETRY_STREAM_INTERVAL_SECONDS)
+
+
+async def telemetry_stream(scope, receive, send, headers, session, job_id):
+    job_id = int(job_id)
+    job = await _run_in_executor(training_queue.get_job, job_id)
+    if not job or job.username != session.get('username'):
+        return await call_flask(scope, receive, send)
+    await send_event_stream(receive, send, telemetry_events(job_id))
+
+
+def _read_chunk(f):
+    return f.read(FILE_CHUNK_BYTES)
+
+
+def _etag_matches(if_none_match, etag):
+    """If-None-Match comparison, weak like RFC 9110 asks for."""
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or any(tag.replace('W/', '', 1) == '"%s"' % etag for tag in tags)
+
+
+async def send_file(scope, receive, send, headers, file_path, cache_control, hashed=False):
+    """Send a file like file_responses.send_user_file, reading it in the executor chunk by chunk."""
+    # If-None-Match, when sent, decides instead of If-Modified-Since.
+    if 'range' in headers or 'if-range' in headers or ('if-modified-since' in headers and 'if-none-match' not in headers):
+        # Flask answers these (partial content, 304).
+        return await call_flask(scope, receive, send)
+    stat = await _run_in_executor(os.stat, file_path)
+    (folder, file_name) = os.path.split(file_path)
+    etag = await _run_in_executor(file_responses.file_etag, folder, file_name, stat, hashed)
+    validators = [
+        ('etag', '"%s"' % etag),
+        ('last-modified', formatdate(stat.st_mtime, usegmt=True)),
+        ('cache-control', cache_control),
+    ]
+    if 'if-none-match' in headers:
+        if _etag_matches(headers['if-none-match'], etag):
+            await start_response(send, 304, validators)
+            return await send_body(send, b'', more_body=False)
+    mimetype = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+    await start_response(send, 200, [
+        ('content-type', mimetype),
+        ('content-length', stat.st_size),
+        ('accept-ranges', 'bytes'),
+    ] + validators)
+    if scope['method'] == 'HEAD':
+        return await send_body(send, b'', more_body=False)
+    f = await _run_in_executor(open, file_path, 'rb')
+    try:
+        while True:
+            data = await _run_in_executor(_read_chunk, f)
+            if not data:
+                break
+            await send_body(send, data)
+    finally:
+        await _run_in_executor(f.close)
+    await send_body(send, b'', more_body=False)
+
+
+async def download(scope, receive, send, headers, session, name):
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    try:
+        (real_folder, filename) = flask_app.resolve_user_file(session['username'], name, query.get('path', [''])[0])
+    except Exception:
+        return await call_flask(scope, receive, send)
+    file_path = safe_join(real_folder, filename)
+    if not file_path or not os.path.isfile(file_path):
+        return await call_flask(scope, receive, send)
+    await send_file(scope, receive, send, headers, file_path, file_responses.USER_FILE_CACHE_CONTROL)
+
+
+async def imagefiles(scope, receive, send, headers, session, name):
+    folder = helpers.generate_image_folder(session['username'])
+    file_path = safe_join(folder, name)
+    if not file_path or not os.path.isfile(file_path):
+        return await call_flask(scope, receive, send)
+    await send_file(scope, receive, send, headers, file_path, file_responses.USER_FILE_CACHE_CONTROL, hashed=True)
+
+
+ROUTES = [
+    (re.compile(r'^/stream$'), stream),
+    (re.compile(r'^/api/training/(\d+)/telemetry/stream$'), telemetry_stream),
+    (re.compile(r'^/download/([^/]+)$'), download),
+    (re.compile(r'^/imagefiles/([^/]+)$'), imagefiles),
+]
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD'):
+        for (pattern, handler) in ROUTES:
+            match = pattern.match(scope['path'])
+            if not match:
+                continue
+            headers = get_headers(scope)
+            session = load_session(headers)
+            if not session.get('logged_in'):
+                break
+            try:
+                return await handler(scope, receive, send, headers, session, *match.groups())
+            except Exception as e:
+                logger.exception(e)
+                raise
+    await call_flask(scope, receive, send)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+TesseractOcrTraining Upgrade Script to Version 1.0.3
+
+Adds the tables used by the persistent training queue:
+- training_job (one row per training)
+- training_runner (state row of the training runner)
+"""
+
+import argparse
+import datetime
+import logging
+import os
+import sqlite3
+import sys
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.StreamHandler(sys.stdout),
+        logging.FileHandler('upgrade_1.0.3.log')
+    ]
+)
+logger = logging.getLogger(__name__)
+
+DEFAULT_DATABASE_PATH = '/var/www/tesseracttraining/accounts.db'
+
+# Columns per table, in creation order. Columns missing from an older table
+# are added with ALTER TABLE.
+TRAINING_JOB_COLUMNS = [
+    ('username', 'VARCHAR(30) NOT NULL DEFAULT \'\''),
+    ('model_name', 'VARCHAR(255) NOT NULL DEFAULT \'\''),
+    ('start_template', 'VARCHAR(255)'),
+    ('more_parameters', 'TEXT'),
+    ('continue_from', 'VARCHAR(255)'),
+    ('replay_percent', 'INTEGER'),
+    ('early_stop_checkpoints', 'INTEGER'),
+    ('log_filename', 'VARCHAR(512) NOT NULL DEFAULT \'\''),
+    ('status', 'VARCHAR(20) NOT NULL DEFAULT \'queued\''),
+    ('message', 'TEXT'),
+    ('created_at', 'DATETIME'),
+    ('started_at', 'DATETIME'),
+    ('finished_at', 'DATETIME'),
+    ('runner_pid', 'INTEGER'),
+    ('process_pid', 'INTEGER'),
+    ('process_group_id', 'INTEGER'),
+]
+
+TRAINING_RUNNER_COLUMNS = [
+    ('pid', 'INTEGER'),
+    ('hostname', 'VARCHAR(255)'),
+    ('slot_count', 'INTEGER'),
+    ('started_at', 'DATETIME'),
+    ('heartbeat_at', 'DATETIME'),
+]
+
+TABLES = [
+    ('training_job', TRAINING_JOB_COLUMNS),
+    ('training_runner', TRAINING_RUNNER_COLUMNS),
+]
+
+
+class DatabaseUpgrader:
+    def __init__(self, database_path):
+        self.database_path = database_path
+        self.connection = None
+        self.backup_path = None
+
+    def connect(self):
+        try:
+            self.connection = sqlite3.connect(self.database_path)
+            self.connection.execute("PRAGMA foreign_keys = ON")
+            logger.info("Connected to database: %s", self.database_path)
+            return True
+        except Exception as e:
+            logger.error("Failed to connect to database: %s", e)
+            return False
+
+    def create_backup(self):
+        try:
+            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+            self.backup_path = f"{self.database_path}.backup_{timestamp}"
+            with open(self.database_path, 'rb') as src:
+                with open(self.backup_path, 'wb') as dst:
+                    dst.write(src.read())
+            logger.info("Backup created: %s", self.backup_path)
+            return True
+        except Exception as e:
+            logger.warning("Failed to create backup: %s", e)
+            return False
+
+    def table_exists(self, table_name):
+        cur = self.connection.cursor()
+        cur.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name=?",
+            (table_name,)
+        )
+        return cur.fetchone()[0] > 0
+
+    def column_exists(self, table_name, column_name):
+        cur = self.connection.cursor()
+        cur.execute(f"PRAGMA table_info({table_name})")
+        return any(row[1].lower() == column_name.lower() for row in cur.fetchall())
+
+    def create_tables(self):
+        try:
+            cur = self.connection.cursor()
+            for table_name, columns in TABLES:
+                cur.execute(f"CREATE TABLE IF NOT EXISTS {table_name} (id INTEGER PRIMARY KEY AUTOINCREMENT)")
+                for column_name, column_type in columns:
+                    if not self.column_exists(table_name, column_name):
+                        cur.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}")
+                        logger.info("Added column %s.%s", table_name, column_name)
+                logger.info("%s table created/verified", table_name)
+            cur.execute("CREATE INDEX IF NOT EXISTS ix_training_job_username ON training_job(username)")
+            cur.execute("CREATE INDEX IF NOT EXISTS ix_training_job_status ON training_job(status)")
+            return True
+        except Exception as e:
+            logger.error("Failed to create/verify tables: %s", e)
+            return False
+
+    def verify(self):
+        for table_name, columns in TABLES:
+            if not self.table_exists(table_name):
+                logger.error("Verification failed: %s table does not exist", table_name)
+                return False
+            for column_name, _ in columns:
+                if not self.column_exists(table_name, column_name):
+                    logger.error("Verification failed: %s.%s missing", table_name, column_name)
+                    return False
+        logger.info("Verification passed")
+        return True
+
+    def upgrade(self):
+        logger.info("Starting upgrade to version 1.0.3")
+        if not self.connect():
+            return False
+        try:
+            self.create_backup()
+            self.connection.execute("BEGIN TRANSACTION")
+
+            steps = [
+                ("Create training queue tables", self.create_tables),
+                ("Verify upgrade", self.verify),
+            ]
+            for step_name, step_func in steps:
+                logger.info("Step: %s", step_name)
+                if not step_func():
+                    self.connection.execute("ROLLBACK")
+                    logger.error("Upgrade failed at step: %s", step_name)
+                    return False
+
+            self.connection.execute("COMMIT")
+            logger.info("SUCCESS: Upgrade to 1.0.3 completed")
+            return True
+        except Exception as e:
+            logger.error("Upgrade exception: %s", e)
+            try:
+                self.connection.execute("ROLLBACK")
+            except Exception:
+                pass
+            return False
+        finally:
+            if self.connection:
+                self.connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Upgrade TesseractOcrTraining to 1.0.3")
+    parser.add_argument(
+        '--database-path',
+        default=DEFAULT_DATABASE_PATH,
+        help=f'Path to database file (default: {DEFAULT_DATABASE_PATH})'
+    )
+    args = parser.parse_args()
+
+    if not os.path.exists(args.database_path):
+        logger.info("Database file does not exist, will be created: %s", args.database_path)
+        os.makedirs(os.path.dirname(args.database_path), exist_ok=True)
+
+    upgrader = DatabaseUpgrader(args.database_path)
+    if upgrader.upgrade():
+        sys.exit(0)
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
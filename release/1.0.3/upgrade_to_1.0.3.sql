@@ -0,0 +1,45 @@
+-- ============================================================================
+-- TesseractOcrTraining Upgrade Script to Version 1.0.3
+-- ============================================================================
+-- This script upgrades the database to version 1.0.3 by adding:
+-- 1. training_job table (persistent training queue)
+-- 2. training_runner table (state row of the training runner)
+--
+-- Compatible with SQLite
+-- ============================================================================
+
+PRAGMA foreign_keys = ON;
+
+-- Training queue, one row per submitted training.
+CREATE TABLE IF NOT EXISTS training_job (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username VARCHAR(30) NOT NULL,
+    model_name VARCHAR(255) NOT NULL,
+    start_template VARCHAR(255),
+    more_parameters TEXT,
+    continue_from VARCHAR(255),
+    replay_percent INTEGER,
+    early_stop_checkpoints INTEGER,
+    log_filename VARCHAR(512) NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'queued',
+    message TEXT,
+    created_at DATETIME NOT NULL,
+    started_at DATETIME,
+    finished_at DATETIME,
+    runner_pid INTEGER,
+    process_pid INTEGER,
+    process_group_id INTEGER
+);
+
+CREATE INDEX IF NOT EXISTS ix_training_job_username ON training_job(username);
+CREATE INDEX IF NOT EXISTS ix_training_job_status ON training_job(status);
+
+-- State of the training runner, a single row with id 1.
+CREATE TABLE IF NOT EXISTS training_runner (
+    id INTEGER PRIMARY KEY,
+    pid INTEGER,
+    hostname VARCHAR(255),
+    slot_count INTEGER,
+    started_at DATETIME,
+    heartbeat_at DATETIME
+);
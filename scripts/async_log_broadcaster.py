@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio counterpart of log_broadcaster, used by the ASGI entry point (asgi.py).
+
+One task per log file follows it and fans new chunks out to bounded
+asyncio queues, so an idle subscriber is only a suspended coroutine. The
+task waits for changes with an inotify fd registered on the event loop, or
+polls with asyncio.sleep where there is no inotify. File reads and the
+is_finished callback (a database query) run in the default executor.
+"""
+
+import asyncio
+import logging
+import os
+
+from scripts.log_broadcaster import SUBSCRIBER_QUEUE_SIZE, IDLE_CHECK_SECONDS, read_range, last_line_end
+from scripts.log_tailer import (InotifyWatch, read_lines, MAX_CHUNK_BYTES, POLL_MIN_SECONDS, POLL_MAX_SECONDS,
+                                DEFAULT_FLUSH_INTERVAL_SECONDS, DEFAULT_KEEP_ALIVE_SECONDS)
+
+logger = logging.getLogger('MainProgram')
+
+_END = object()
+_DROPPED = object()
+
+_broadcasters = {}
+
+
+async def _run_in_executor(function, *args):
+    return await asyncio.get_event_loop().run_in_executor(None, function, *args)
+
+
+class AsyncSubscription:
+    """Async iteration over the log: the backlog first, then the chunks of the broadcaster."""
+
+    def __init__(self, broadcaster, start_offset, keep_alive, resume_offset=0):
+        self.broadcaster = broadcaster
+        self.start_offset = start_offset
+        self.keep_alive = keep_alive
+        self.resume_offset = resume_offset
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.dropped = False
+
+    async def __aiter__(self):
+        try:
+            backlog = read_range(self.broadcaster.path, self.resume_offset, self.start_offset)
+            while True:
+                chunk = await _run_in_executor(next, backlog, None)
+                if chunk is None:
+                    break
+                yield chunk
+            offset = max(self.start_offset, self.resume_offset)
+            while True:
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), self.keep_alive)
+                except asyncio.TimeoutError:
+                    yield offset, None
+                    continue
+                if item is _END:
+                    return
+                if item is _DROPPED:
+                    self.dropped = True
+                    return
+                if item[0] <= offset:
+                    continue
+                offset = item[0]
+                yield item
+        finally:
+            self.broadcaster.subscribers.discard(self)
+
+
+class AsyncLogBroadcaster:
+    """Follow one file in a task and fan its chunks out to the subscribers."""
+
+    def __init__(self, path, offset, is_finished=None):
+        self.path = path
+        self.offset = offset
+        self.is_finished = is_finished
+        self.subscribers = set()
+        self.stopped = False
+        self._changed = asyncio.Event()
+        self._poll_delay = POLL_MIN_SECONDS
+
+    def subscribe(self, keep_alive=DEFAULT_KEEP_ALIVE_SECONDS, resume_offset=0):
+        subscription = AsyncSubscription(self, self.offset, keep_alive, resume_offset)
+        self.subscribers.add(subscription)
+        return subscription
+
+    def _publish(self, item):
+        for subscription in list(self.subscribers):
+            try:
+                subscription.queue.put_nowait(item)
+            except asyncio.QueueFull:
+                logger.info('Dropping a slow client of %s' % self.path)
+                self.subscribers.discard(subscription)
+                while not subscription.queue.empty():
+                    subscription.queue.get_nowait()
+                subscription.queue.put_nowait(_DROPPED)
+
+    async def _wait(self, watch, timeout):
+        """Wait for the file to change, True on a change."""
+        if watch:
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                return False
+            self._changed.clear()
+            watch.drain()
+            return True
+        delay = min(self._poll_delay, timeout)
+        size_before = os.path.getsize(self.path)
+        await asyncio.sleep(delay)
+        changed = os.path.getsize(self.path) != size_before
+        self._poll_delay = POLL_MIN_SECONDS if changed else min(self._poll_delay * 2, POLL_MAX_SECONDS)
+        return changed
+
+    async def _finished(self):
+        if self.is_finished is None:
+            return True
+        return await _run_in_executor(self.is_finished)
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        watch = None
+        f = open(self.path, 'rb')
+        try:
+            try:
+                watch = InotifyWatch(self.path)
+                loop.add_reader(watch.fd, self._changed.set)
+            except OSError as e:
+                logger.debug('Polling %s: %s' % (self.path, e))
+                watch = None
+            while self.subscribers:
+                data = await _run_in_executor(read_lines, f, self.offset, MAX_CHUNK_BYTES)
+                if data:
+                    self.offset += len(data)
+                    self._publish((self.offset, data.decode('utf-8', errors='replace')))
+                    continue
+                if await self._finished():
+                    # The writer is done, hand out what it wrote meanwhile.
+                    data = await _run_in_executor(read_lines, f, self.offset, MAX_CHUNK_BYTES, True)
+                    while data:
+                        self.offset += len(data)
+                        self._publish((self.offset, data.decode('utf-8', errors='replace')))
+                        data = await _run_in_executor(read_lines, f, self.offset, MAX_CHUNK_BYTES, True)
+                    break
+                if await self._wait(watch, IDLE_CHECK_SECONDS):
+                    await asyncio.sleep(DEFAULT_FLUSH_INTERVAL_SECONDS)
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            if watch:
+                loop.remove_reader(watch.fd)
+                watch.close()
+            f.close()
+            if _broadcasters.get(self.path) is self:
+                del _broadcasters[self.path]
+            self.stopped = True
+            self._publish(_END)
+
+
+async def subscribe(path, is_finished=None, keep_alive=DEFAULT_KEEP_ALIVE_SECONDS, offset=0):
+    """AsyncSubscription to the log at path from byte offset on, see log_broadcaster.subscribe."""
+    path = os.path.abspath(path)
+    offset = max(0, min(offset, os.path.getsize(path)))
+    broadcaster = _broadcasters.get(path)
+    if broadcaster is None or broadcaster.stopped:
+        start_offset = await _run_in_executor(last_line_end, path)
+        # Another request may have started one while we were reading.
+        broadcaster = _broadcasters.get(path)
+        if broadcaster is None or broadcaster.stopped:
+            broadcaster = AsyncLogBroadcaster(path, start_offset, is_finished)
+            _broadcasters[path] = broadcaster
+            subscription = broadcaster.subscribe(keep_alive, offset)
+            asyncio.ensure_future(broadcaster.run())
+            return subscription
+    return broadcaster.subscribe(keep_alive, offset)
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Ground truth imported from a zip or tar archive of image + .gt.txt pairs,
+as tesstrain keeps them (data/<model>-ground-truth/*.png|tif + *.gt.txt),
+uploaded through /upload like single images.
+
+The archive is read entry by entry from the upload: a tar as a stream, a zip
+from the spooled upload file. Images are stored under the same names as by
+/upload (helpers.get_stored_image_name) and converted to png in the
+image_conversion pool. The text of <name>.gt.txt belongs to the image
+<name>.<image extension> in the same archive folder; it is written next to
+the stored image, named by helpers.get_txtfilename_only_from_image, as soon
+as both are read (in a tar, a text may come before or after its image).
+Images larger than MAX_UPLOAD_FILE_BYTES are skipped one by one; an archive
+over the limits below is refused with RequestEntityTooLarge and what it
+stored so far is removed again. An image whose stored name an
+earlier image of the archive already has, or whose text would (the same name
+in another archive folder, name.png next to name.tif), is stored with its
+folder path as prefix, <folder>_<sub>_<name>. The folder's dataset_manifest is
+locked during the import.
+"""
+
+import logging
+import os
+import tarfile
+import zipfile
+
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from scripts import dataset_manifest
+from scripts import helpers
+from scripts import image_conversion
+
+logger = logging.getLogger('MainProgram')
+
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+IMAGE_EXTENSIONS = ('.png', '.tif', '.tiff', '.bmp', '.jpg', '.jpeg', '.ico')
+TEXT_SUFFIX = '.gt.txt'
+# Limits against archive bombs, on top of MAX_UPLOAD_FILE_BYTES per image.
+MAX_ARCHIVE_ENTRIES = 100000
+MAX_EXTRACTED_BYTES = 8 * 1024 * 1024 * 1024
+MAX_TEXT_BYTES = 64 * 1024
+
+
+def is_archive(filename):
+    return filename.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def _iter_zip(stream):
+    with zipfile.ZipFile(stream) as archive:
+        for info in archive.infolist():
+            if not info.is_dir():
+                with archive.open(info) as entry:
+                    yield info.filename, info.file_size, entry
+
+
+def _iter_tar(stream):
+    # 'r|*' reads the archive front to back without seeking.
+    with tarfile.open(fileobj=stream, mode='r|*') as archive:
+        for info in archive:
+            if info.isfile():
+                yield info.name, info.size, archive.extractfile(info)
+
+
+def _pair_key(entry_name, suffix):
+    """Archive folder and name without suffix, the same for an image and its text."""
+    return entry_name[:-len(suffix)].lower()
+
+
+def _text_name_key(final_filename):
+    return helpers.get_txtfilename_only_from_image(final_filename).lower()
+
+
+def _unique_name(entry_name, final_filename, used_names):
+    """final_filename, or a name made unique with the entry's archive folders when the archive used it already.
+
+    used_names holds the _text_name_key of the names used so far.
+    """
+    if _text_name_key(final_filename) not in used_names:
+        return final_filename
+    prefix = os.path.dirname(entry_name).strip('/').replace('/', '_')
+    candidate = '%s_%s' % (prefix, final_filename) if prefix else final_filename
+    number = 1
+    while _text_name_key(candidate) in used_names:
+        number += 1
+        candidate = '%s_%s' % (number, final_filename) if not prefix else '%s_%s_%s' % (prefix, number, final_filename)
+    return candidate
+
+
+def ingest_archive(username, fileitem):
+    """Store the image + text pairs of the uploaded archive. Returns a message for the user."""
+    folder = helpers.generate_image_folder(username)
+    helpers.create_folder_if_not_exists(folder)
+    if fileitem.filename.lower().endswith('.zip'):
+        entries = _iter_zip(fileitem.stream)
+    else:
+        entries = _iter_tar(fileitem.stream)
+    stored_filenames = []
+    with dataset_manifest.updating(folder) as manifest:
+        try:
+            message = _ingest_entries(username, fileitem, folder, entries, manifest, stored_filenames)
+        except:
+            _remove_stored(username, folder, stored_filenames, manifest)
+            raise
+    logger.info('%s imported %s' % (username, message))
+    return message
+
+
+def _remove_stored(username, folder, stored_filenames, manifest):
+    """Remove the images of a failed import, with their conversions and texts."""
+    for final_filename in stored_filenames:
+        text_filename = helpers.get_txtfilename_only_from_image(final_filename)
+        names = (final_filename, final_filename + image_conversion.PENDING_SUFFIX,
+                 final_filename + image_conversion.FAILED_SUFFIX, text_filename)
+        for name in names:
+            path = os.path.join(folder, name)
+            if os.path.exists(path):
+                os.remove(path)
+        manifest.touch(*names)
+    if stored_filenames:
+        logger.info('%s: removed the %s images of the failed import' % (username, len(stored_filenames)))
+
+
+def _write_text(username, final_filename, text, manifest):
+    helpers.write_image_text(username, final_filename, text)
+    manifest.touch(helpers.get_txtfilename_only_from_image(final_filename))
+
+
+def _ingest_entries(username, fileitem, folder, entries, manifest, stored_filenames):
+    """Store the entries, appending the stored image names to stored_filenames. Returns the message."""
+    # {pair key: [stored file names]} and {pair key: text}
+    stored_images = {}
+    texts = {}
+    used_names = set()
+    (entry_count, extracted_bytes, converting, skipped, oversize, renamed) = (0, 0, 0, 0, 0, 0)
+    for (entry_name, size, entry) in entries:
+        entry_count += 1
+        if entry_count > MAX_ARCHIVE_ENTRIES:
+            raise RequestEntityTooLarge('%s has more than %s files' % (fileitem.filename, MAX_ARCHIVE_ENTRIES))
+        extracted_bytes += size
+        if extracted_bytes > MAX_EXTRACTED_BYTES:
+            raise RequestEntityTooLarge('%s unpacks to more than %s GB' % (fileitem.filename, MAX_EXTRACTED_BYTES // 1024 ** 3))
+        base_name = os.path.basename(entry_name)
+        lower_name = base_name.lower()
+        if not base_name or base_name.startswith('.') or '__MACOSX' in entry_name:
+            skipped += 1
+        elif lower_name.endswith(TEXT_SUFFIX):
+            if size > MAX_TEXT_BYTES:
+                skipped += 1
+                continue
+            data = entry.read(MAX_TEXT_BYTES + 1)
+            key = _pair_key(entry_name, TEXT_SUFFIX)
+            try:
+                texts[key] = data.decode('utf-8')
+            except UnicodeDecodeError:
+                skipped += 1
+                continue
+            for final_filename in stored_images.get(key, []):
+                _write_text(username, final_filename, texts[key], manifest)
+        elif lower_name.endswith(IMAGE_EXTENSIONS):
+            try:
+                temp_path = helpers.copy_stream_to_temp_file(entry, entry_name, folder)
+            except RequestEntityTooLarge as e:
+                logger.warning('%s: skipped %s' % (fileitem.filename, e.description))
+                oversize += 1
+                continue
+            (final_filename, need_convert_image_file) = helpers.get_stored_image_name(base_name)
+            unique_filename = _unique_name(entry_name, final_filename, used_names)
+            if unique_filename != final_filename:
+                logger.info('%s: %s stored as %s' % (fileitem.filename, entry_name, unique_filename))
+                (final_filename, renamed) = (unique_filename, renamed + 1)
+            used_names.add(_text_name_key(final_filename))
+            final_path = os.path.join(folder, final_filename)
+            stored_filenames.append(final_filename)
+            if need_convert_image_file:
+                image_conversion.submit_conversion(temp_path, final_path)
+                manifest.touch(final_filename + image_conversion.PENDING_SUFFIX, final_filename + image_conversion.FAILED_SUFFIX)
+                converting += 1
+            else:
+                os.replace(temp_path, final_path)
+                manifest.touch(final_filename)
+            key = _pair_key(entry_name, os.path.splitext(lower_name)[1])
+            stored_images.setdefault(key, []).append(final_filename)
+            if key in texts:
+                _write_text(username, final_filename, texts[key], manifest)
+        else:
+            skipped += 1
+    paired = sum(len(stored_images[key]) for key in texts if key in stored_images)
+    message = '%s: %s images (%s converting), %s with text, %s texts without image, %s other files skipped' % (
+        fileitem.filename, len(stored_filenames), converting, paired, len(set(texts) - set(stored_images)), skipped)
+    if oversize:
+        message += ', %s images larger than %s MB skipped' % (oversize, helpers.MAX_UPLOAD_FILE_BYTES // (1024 * 1024))
+    if renamed:
+        message += ', %s images renamed with their folder because an earlier image of the archive has the same name' % renamed
+    return message
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""
+Per-user manifest of the image folder: the file names, the content of the
+.gt.txt files and the sha256 of the files, kept in
+<user>/.manifest/images.json. The hashes are made when first asked for by
+get_file_hashes, outside the lock, and kept for the file's size and mtime;
+they are the ETags of /imagefiles (see file_responses) and the keys of the
+ground truth cache (see training_cache).
+
+Listing the images reads the manifest instead of the folder. It stays valid
+as long as the modification time of the folder is the one it was saved
+with; checking that costs a stat of the folder and of the manifest files
+(which are also cached per process). When the folder changed behind its back,
+the manifest is brought up to date with a scandir, reading only the texts
+that are new or changed.
+
+The app changes the folder inside updating(), which holds an flock on the
+manifest and records the changed names with touch(); the manifest then
+stays valid without a rescan. An update appends one line with the entries
+of the touched names to images.log, so its cost does not grow with the
+dataset; the processes that have the manifest cached read only the lines
+added since. After a rescan, or once the log is larger than images.json,
+images.json is written again with a new generation and the log emptied
+(lines of an older generation are ignored). Temp files are prepared in scratch_folder(),
+a subfolder, because creating them in the folder itself would change its
+modification time.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import stat
+import threading
+from contextlib import contextmanager
+
+MANIFEST_FOLDER = '.manifest'
+SCRATCH_FOLDER = '.uploads'
+TEXT_SUFFIX = '.gt.txt'
+HASH_CHUNK_BYTES = 1024 * 1024
+MIN_COMPACTED_LOG_BYTES = 64 * 1024
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def manifest_path(folder):
+    return os.path.join(folder, MANIFEST_FOLDER, 'images.json')
+
+
+def log_path(folder):
+    return os.path.join(folder, MANIFEST_FOLDER, 'images.log')
+
+
+def scratch_folder(folder):
+    """Folder for temp files that are renamed into folder when complete."""
+    path = os.path.join(folder, SCRATCH_FOLDER)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _dir_mtime_ns(folder):
+    return os.stat(folder).st_mtime_ns
+
+
+def _read_text(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+    except UnicodeDecodeError:
+        return ''
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_BYTES)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """File names of the folder (no folders), {text file name: [mtime_ns, size, text]}
+    and {file name: [mtime_ns, size, sha256]}."""
+
+    def __init__(self, folder, data=None):
+        data = data or {}
+        self.folder = folder
+        self.generation = data.get('generation', 0)
+        self.dir_mtime_ns = data.get('dir_mtime_ns')
+        self.files = set(data.get('files', []))
+        self.texts = data.get('texts', {})
+        self.hashes = data.get('hashes', {})
+        # os.stat of images.json as (st_ino, st_mtime_ns) and the bytes of
+        # images.log applied, see _load.
+        (self.snapshot_id, self.log_offset) = (None, 0)
+        # Names touched since loaded, and whether rescan() ran.
+        (self.changed, self.rescanned) = (set(), False)
+        (self._sorted_files, self._lower_files) = (None, None)
+
+    def copy(self):
+        """A copy to change, leaving this one to the readers that have it."""
+        manifest = Manifest(self.folder)
+        (manifest.generation, manifest.dir_mtime_ns) = (self.generation, self.dir_mtime_ns)
+        (manifest.files, manifest.texts, manifest.hashes) = (set(self.files), dict(self.texts), dict(self.hashes))
+        (manifest.snapshot_id, manifest.log_offset) = (self.snapshot_id, self.log_offset)
+        return manifest
+
+    def to_json(self):
+        return {'generation': self.generation, 'dir_mtime_ns': self.dir_mtime_ns, 'files': sorted(self.files),
+                'texts': self.texts, 'hashes': self.hashes}
+
+    def changes_to_json(self):
+        """Line of images.log with the entries of the changed names, None for a removed one."""
+        entries = {}
+        for name in self.changed:
+            entries[name] = {'text': self.texts.get(name), 'hash': self.hashes.get(name)} if name in self.files else None
+        return {'generation': self.generation, 'dir_mtime_ns': self.dir_mtime_ns, 'entries': entries}
+
+    def apply_changes(self, record):
+        (self._sorted_files, self._lower_files) = (None, None)
+        for (name, entry) in record['entries'].items():
+            if entry is None:
+                self.files.discard(name)
+                self.texts.pop(name, None)
+                self.hashes.pop(name, None)
+                continue
+            self.files.add(name)
+            for (entries, value) in ((self.texts, entry['text']), (self.hashes, entry['hash'])):
+                if value is None:
+                    entries.pop(name, None)
+                else:
+                    entries[name] = value
+        self.dir_mtime_ns = record['dir_mtime_ns']
+
+    def touch(self, *names):
+        """Bring the entries of the named files up to date with the folder."""
+        (self._sorted_files, self._lower_files) = (None, None)
+        self.changed.update(names)
+        for name in names:
+            path = os.path.join(self.folder, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                st = None
+            if st is None or stat.S_ISDIR(st.st_mode):
+                self.files.discard(name)
+                self.texts.pop(name, None)
+                self.hashes.pop(name, None)
+                continue
+            self.files.add(name)
+            if name.lower().endswith(TEXT_SUFFIX):
+                entry = self.texts.get(name)
+                if not entry or entry[0] != st.st_mtime_ns or entry[1] != st.st_size:
+                    self.texts[name] = [st.st_mtime_ns, st.st_size, _read_text(path)]
+            if name in self.hashes and not self.get_hash(name, st):
+                del self.hashes[name]
+
+    def rescan(self):
+        (self._sorted_files, self._lower_files) = (None, None)
+        self.rescanned = True
+        with os.scandir(self.folder) as entries:
+            names = set(e.name for e in entries if not e.is_dir())
+        for name in self.files - names:
+            self.files.discard(name)
+            self.texts.pop(name, None)
+            self.hashes.pop(name, None)
+        # New files, and texts that may have been edited in place.
+        self.touch(*[n for n in names if n not in self.files or n.lower().endswith(TEXT_SUFFIX)])
+
+    def sorted_files(self):
+        """The file names sorted, computed once per loaded manifest."""
+        if self._sorted_files is None:
+            self._sorted_files = sorted(self.files)
+        return self._sorted_files
+
+    def find_file(self, name):
+        """The file name matching name case-insensitively, or None."""
+        if self._lower_files is None:
+            self._lower_files = {v.lower(): v for v in self.files}
+        return self._lower_files.get(name.lower())
+
+    def get_hash(self, name, st):
+        """sha256 of the file name with the os.stat result st, or None when not known for that version."""
+        entry = self.hashes.get(name)
+        if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+            return entry[2]
+        return None
+
+    def set_hash(self, name, entry):
+        """Record [mtime_ns, size, sha256] of the file name, made outside the lock."""
+        self.hashes[name] = entry
+        self.changed.add(name)
+
+    def get_text(self, name):
+        entry = self.texts.get(name)
+        return entry[2] if entry else ''
+
+
+def _read_log(manifest):
+    """Apply the lines of images.log written since manifest.log_offset to manifest."""
+    try:
+        with open(log_path(manifest.folder), 'rb') as f:
+            f.seek(manifest.log_offset)
+            data = f.read()
+    except FileNotFoundError:
+        return
+    # A line still being appended is read next time.
+    end = data.rfind(b'\n') + 1
+    for line in data[:end].splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if record.get('generation') == manifest.generation:
+            manifest.apply_changes(record)
+    manifest.log_offset += end
+
+
+def _load(folder):
+    """The manifest of images.json and images.log, cached per process; copy() it to change it."""
+    try:
+        st = os.stat(manifest_path(folder))
+    except FileNotFoundError:
+        return Manifest(folder)
+    snapshot_id = (st.st_ino, st.st_mtime_ns)
+    with _cache_lock:
+        manifest = _cache.get(folder)
+    if manifest is None or manifest.snapshot_id != snapshot_id:
+        try:
+            with open(manifest_path(folder), 'r', encoding='utf-8') as f:
+                manifest = Manifest(folder, json.load(f))
+        except ValueError:
+            return Manifest(folder)
+        manifest.snapshot_id = snapshot_id
+    try:
+        log_size = os.path.getsize(log_path(folder))
+    except FileNotFoundError:
+        log_size = 0
+    if log_size > manifest.log_offset:
+        # Not in place, readers in other threads may be using it.
+        manifest = manifest.copy()
+        _read_log(manifest)
+    with _cache_lock:
+        _cache[folder] = manifest
+    return manifest
+
+
+def _save(manifest):
+    """Append the changes to images.log, or write images.json again when it is time to."""
+    record = json.dumps(manifest.changes_to_json(), separators=(',', ':')).encode('utf-8') + b'\n'
+    snapshot_bytes = os.path.getsize(manifest_path(manifest.folder)) if manifest.snapshot_id else 0
+    if manifest.snapshot_id and not manifest.rescanned \
+            and manifest.log_offset + len(record) <= max(MIN_COMPACTED_LOG_BYTES, snapshot_bytes):
+        with open(log_path(manifest.folder), 'ab') as f:
+            f.write(record)
+        manifest.log_offset += len(record)
+    else:
+        manifest.generation += 1
+        path = manifest_path(manifest.folder)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest.to_json(), f, separators=(',', ':'))
+        os.replace(temp_path, path)
+        open(log_path(manifest.folder), 'wb').close()
+        st = os.stat(path)
+        (manifest.snapshot_id, manifest.log_offset) = ((st.st_ino, st.st_mtime_ns), 0)
+    (manifest.changed, manifest.rescanned) = (set(), False)
+    with _cache_lock:
+        _cache[manifest.folder] = manifest
+
+
+@contextmanager
+def updating(folder):
+    """Change the folder under the manifest lock, yielding the manifest to touch() the changed names on."""
+    os.makedirs(os.path.dirname(manifest_path(folder)), exist_ok=True)
+    with open(manifest_path(folder) + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        # Not the cached one, which readers in other threads may be using.
+        manifest = _load(folder).copy()
+        if manifest.dir_mtime_ns != _dir_mtime_ns(folder):
+            manifest.rescan()
+        yield manifest
+        manifest.dir_mtime_ns = _dir_mtime_ns(folder)
+        _save(manifest)
+
+
+def get_manifest(folder):
+    """The up to date manifest of folder; do not change it."""
+    os.makedirs(folder, exist_ok=True)
+    manifest = _load(folder)
+    if manifest.dir_mtime_ns != _dir_mtime_ns(folder):
+        with updating(folder):
+            pass
+        manifest = _load(folder)
+    return manifest
+
+
+def _hash_unchanged(path):
+    """(os.stat result, sha256) of the file, sha256 None when it changed while being read."""
+    st = os.stat(path)
+    digest = _hash_file(path)
+    after = os.stat(path)
+    if (after.st_mtime_ns, after.st_size) != (st.st_mtime_ns, st.st_size):
+        digest = None
+    return st, digest
+
+
+def get_file_hashes(folder, names):
+    """{name: sha256} of the named files of folder, leaving out missing ones.
+
+    Files the manifest has no hash of for their current size and mtime are
+    hashed without the lock, then stored in the manifest in one update.
+    """
+    manifest = get_manifest(folder)
+    (result, new_hashes) = ({}, {})
+    for name in names:
+        path = os.path.join(folder, name)
+        try:
+            content_hash = manifest.get_hash(name, os.stat(path))
+            if not content_hash:
+                (st, content_hash) = _hash_unchanged(path)
+                if content_hash:
+                    new_hashes[name] = [st.st_mtime_ns, st.st_size, content_hash]
+        except FileNotFoundError:
+            continue
+        if content_hash:
+            result[name] = content_hash
+    if new_hashes:
+        with updating(folder) as manifest:
+            for (name, entry) in new_hashes.items():
+                try:
+                    st = os.stat(os.path.join(folder, name))
+                except FileNotFoundError:
+                    continue
+                if name in manifest.files and [st.st_mtime_ns, st.st_size] == entry[:2]:
+                    manifest.set_hash(name, entry)
+    return result
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Responses for the user file routes, with the same validators and
+Cache-Control in the Flask views and the native handlers of asgi.py.
+
+The ETag is strong: for the files of the image folder their sha256, kept in
+the dataset_manifest once made, else the file's size and mtime in
+nanoseconds. Flask's send_file answers If-None-Match, If-Modified-Since,
+Range and If-Range (206 partial content, 304 not modified), so browsers
+revalidate images instead of downloading them again and interrupted
+downloads resume.
+"""
+
+import os
+
+from flask import send_file
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+
+from scripts import dataset_manifest
+
+# Same URL, changing content: revalidate every time, cheap with the ETag.
+USER_FILE_CACHE_CONTROL = 'private, no-cache'
+# The tiles of a key never change, see image_tiles.
+TILE_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+# Public, but a post's image may be replaced under the same name.
+FORUM_IMAGE_CACHE_CONTROL = 'public, max-age=300'
+
+
+def file_etag(folder, file_name, stat, hashed=False):
+    """ETag (without quotes) of the file file_name in folder with the os.stat result stat.
+
+    With hashed, folder is an image folder and the ETag its sha256, made
+    if needed (see dataset_manifest.get_file_hashes).
+    """
+    content_hash = dataset_manifest.get_file_hashes(folder, [file_name]).get(file_name) if hashed else None
+    return content_hash or '%x-%x' % (stat.st_size, stat.st_mtime_ns)
+
+
+def send_user_file(folder, name, cache_control, hashed=False):
+    """Flask response for the file name in folder; NotFound outside the folder or when missing."""
+    file_path = safe_join(folder, name)
+    if not file_path or not os.path.isfile(file_path):
+        raise NotFound()
+    stat = os.stat(file_path)
+    (file_folder, file_name) = os.path.split(file_path)
+    response = send_file(file_path, etag=file_etag(file_folder, file_name, stat, hashed),
+                         last_modified=stat.st_mtime, conditional=True)
+    response.headers['Cache-Control'] = cache_control
+    return response
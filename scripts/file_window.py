@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Read a window of a text file, however large the file is.
+
+read_text_window returns at most length bytes from the requested offset on,
+cut at a line end where the window has one, so that consecutive windows
+(the next one starting at the end of the previous) show every line once.
+With align, the window starts at the next line instead, for offsets that
+are not the end of an earlier window.
+
+Only the window is read and decoded, UTF-8 with an incremental decoder that
+leaves a character cut at the end for the next window; a window that is not
+UTF-8 is shown as latin-1.
+"""
+
+import codecs
+import os
+
+VIEW_WINDOW_BYTES = 256 * 1024
+MAX_VIEW_WINDOW_BYTES = 4 * 1024 * 1024
+
+
+def _is_continuation_byte(byte):
+    return 0x80 <= byte <= 0xBF
+
+
+def read_text_window(path, offset=0, length=VIEW_WINDOW_BYTES, tail=False, align=False):
+    """(text, start, end, size) of the window, start and end being byte offsets in the file of size bytes.
+
+    With tail, the window is the (aligned) end of the file.
+    """
+    size = os.path.getsize(path)
+    length = max(1, min(length, MAX_VIEW_WINDOW_BYTES))
+    if tail:
+        offset = size - length
+        align = True
+    offset = max(0, min(offset, size))
+    with open(path, 'rb') as f:
+        if offset > 0 and align:
+            # Start at the beginning of a line: right here if the previous
+            # byte ends one, else after the next line end in the window.
+            f.seek(offset - 1)
+            data = f.read(length + 1)
+            newline = data.find(b'\n')
+            if 0 <= newline < len(data) - 1:
+                offset += newline
+                data = data[newline + 1:]
+            else:
+                data = data[1:]
+        else:
+            f.seek(offset)
+            data = f.read(length)
+    # At least start on a character, also within a line.
+    skip = 0
+    while offset > 0 and skip < min(3, len(data)) and _is_continuation_byte(data[skip]):
+        skip += 1
+    offset += skip
+    data = data[skip:]
+    at_end = offset + len(data) >= size
+    if not at_end:
+        cut = data.rfind(b'\n') + 1
+        if cut:
+            data = data[:cut]
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        text = decoder.decode(data, final=at_end)
+        end = offset + len(data) - len(decoder.getstate()[0])
+    except UnicodeDecodeError:
+        text = data.decode('latin-1')
+        end = offset + len(data)
+    return text, offset, end, size
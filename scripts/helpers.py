@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 from scripts import tabledef
+from scripts import image_conversion
+from scripts import dataset_manifest
 from flask import session
 from sqlalchemy.orm import sessionmaker
 from contextlib import contextmanager
@@ -12,14 +14,35 @@ from datetime import datetime
 import time
 from threading import Thread
 import urllib.parse
+import tempfile
+import bisect
+from werkzeug.exceptions import RequestEntityTooLarge
 
 
 root_path ='/var/www/tesseracttraining/files'
 root_path_tessdata ='/usr/local/src/tesstrain/usr/share/tessdata'
+tesstrain_path ='/usr/local/src/tesstrain'
+tesstrain_tessdata_path ='/usr/local/src/tesstrain/tessdata_best'
+tesstrain_jobs_path ='/usr/local/src/tesstrain/jobs'
+tesstrain_cache_path ='/usr/local/src/tesstrain/cache'
 # root_path_tessdata = 'c:/temp'
 
 current_log_name =None
 
+# Uploads are copied to disk UPLOAD_CHUNK_BYTES at a time; one file may have
+# at most MAX_UPLOAD_FILE_BYTES (a whole request: MAX_UPLOAD_REQUEST_BYTES,
+# enforced by Flask).
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+MAX_UPLOAD_FILE_BYTES = 256 * 1024 * 1024
+MAX_UPLOAD_REQUEST_BYTES = 1024 * 1024 * 1024
+
+# /images and /api/images list IMAGES_PAGE_SIZE rows at a time, looking at
+# no more than MAX_IMAGES_PAGE_SCAN file names for one page.
+IMAGES_PAGE_SIZE = 100
+MAX_IMAGES_PAGE_SIZE = 1000
+MAX_IMAGES_PAGE_SCAN = 10000
+TEXT_PREVIEW_CHARS = 300
+
 logger =None
 
 @contextmanager
@@ -236,6 +259,21 @@ def generate_result_folder(username, folder_name) :
         return generate_image_folder(username)
     return os.path.join(root_path, username, folder_name) 
 
+def generate_job_folder(job_id) :
+    return os.path.join(tesstrain_jobs_path, 'job_%s' % job_id)
+
+def generate_job_data_folder(job_id) :
+    return os.path.join(generate_job_folder(job_id), 'data')
+
+def generate_job_scratch_folder(job_id) :
+    return os.path.join(generate_job_folder(job_id), 'tmp')
+
+def generate_job_ground_truth_folder(job_id) :
+    return os.path.join(generate_job_folder(job_id), 'ground-truth')
+
+def generate_job_tessdata_folder(job_id) :
+    return os.path.join(generate_job_folder(job_id), 'tessdata')
+
 def get_current_log_name(username ) :
     log_folder = os.path.join(root_path, username,'logs')
     create_folder_if_not_exists (log_folder)
@@ -263,42 +301,77 @@ def create_folder_if_not_exists(path_name) :
         #print("created folder : ", path_name)
 
 
+def _image_text_row(manifest, one_file) :
+    """(image, text file, text) of list_folder_image_text_pair for one file name, or None."""
+    one_file_lower = one_file.lower()
+    if not one_file or one_file_lower.endswith(('.part', image_conversion.PENDING_SUFFIX, image_conversion.FAILED_SUFFIX)) :
+        # an upload still being written or converted, see list_conversions
+        return None
+    if one_file_lower.endswith('tif') or one_file_lower.endswith('png') :
+        text_filename_case_sensititive = manifest.find_file(get_txtfilename_only_from_image(one_file))
+        if text_filename_case_sensititive :
+            return (one_file, text_filename_case_sensititive, manifest.get_text(text_filename_case_sensititive))
+        return (one_file, '', '')
+    elif  not ( one_file_lower.endswith('.gt.txt')  or one_file_lower.endswith('.lstmf')  or one_file_lower.endswith('.box') ) :
+        return (one_file, '', '')
+    return None
+
 def list_folder_image_text_pair(username) :
-    global root_path 
-    final_path = generate_image_folder(username)
-    create_folder_if_not_exists(final_path)
-    list_of_files_1 = os.listdir(final_path)    
-    if list_of_files_1 is None :
-        list_of_files_1=[]
-    list_of_files =[]
-    
-    for fname in list_of_files_1 :
-        path = os.path.join(final_path, fname)
-        if not os.path.isdir(path):
-            list_of_files.append(fname)
-        
-    list_of_files.sort()
-    
-    hash_set = {v.lower():v for v in list_of_files }
+    """(image, text file, text) for the images, ('' and '' for an image without text) and other files.
+
+    From the manifest of the folder, see dataset_manifest.
+    """
+    manifest = dataset_manifest.get_manifest(generate_image_folder(username))
+    result =[]
+    for one_file in manifest.sorted_files() :
+        row = _image_text_row(manifest, one_file)
+        if row :
+            result.append(row)
+    return result
+
+def list_image_text_page(username, after='', prefix='', text_filter='', limit=IMAGES_PAGE_SIZE) :
+    """One page of list_folder_image_text_pair: (rows, cursor of the next page or '').
+
+    Rows are the ones whose file name comes after the cursor after and starts
+    with prefix (case-sensitive, like the order). text_filter 'missing' or
+    'text' keeps only the images without or with a text. Texts are cut to
+    TEXT_PREVIEW_CHARS. The page ends after limit rows or
+    MAX_IMAGES_PAGE_SCAN file names, whichever comes first.
+    """
+    manifest = dataset_manifest.get_manifest(generate_image_folder(username))
+    names = manifest.sorted_files()
+    limit = max(1, min(limit, MAX_IMAGES_PAGE_SIZE))
+    index = bisect.bisect_right(names, after) if after and after >= prefix else bisect.bisect_left(names, prefix)
+    end = min(len(names), index + MAX_IMAGES_PAGE_SCAN)
+    rows = []
+    while index < end and len(rows) < limit and names[index].startswith(prefix) :
+        row = _image_text_row(manifest, names[index])
+        index += 1
+        if not row :
+            continue
+        has_text = bool(row[1])
+        is_image = row[0].lower().endswith(('tif', 'png'))
+        if text_filter == 'missing' and (has_text or not is_image) :
+            continue
+        if text_filter == 'text' and not has_text :
+            continue
+        rows.append((row[0], row[1], row[2][:TEXT_PREVIEW_CHARS]))
+    more = index < len(names) and names[index].startswith(prefix)
+    return rows, (names[index - 1] if more and index > 0 else '')
+
+def list_training_pairs(username) :
+    """Return (image filename, .gt.txt filename) for every image that has a text file."""
+    manifest = dataset_manifest.get_manifest(generate_image_folder(username))
+    hash_set = {v.lower():v for v in manifest.files }
     result =[]
-    for one_file in list_of_files :
-        if not one_file :
-            continue 
+    for one_file in sorted(hash_set.values()) :
         one_file_lower = one_file.lower()
         if one_file_lower.endswith('tif') or one_file_lower.endswith('png') :
             text_filename = get_txtfilename_only_from_image(one_file).lower()
             if text_filename in hash_set :
-                text_filename_case_sensititive = hash_set[text_filename] 
-                full_text_filename = os.path.join(final_path, text_filename_case_sensititive)
-                text_content = safe_read_image_text(full_text_filename ) 
-                result.append( (one_file, text_filename_case_sensititive, text_content) )
-            else :
-                result.append( (one_file, '', '') )
-        elif  not ( one_file_lower.endswith('.gt.txt')  or one_file_lower.endswith('.lstmf')  or one_file_lower.endswith('.box') ) :
-            result.append( (one_file, '', '') )
-            
+                result.append( (one_file, hash_set[text_filename]) )
     return result
-   
+
 def list_folder_result(username, folder) :
     global root_path 
     final_path = generate_result_folder(username, folder)
@@ -318,27 +391,106 @@ def list_folder_result(username, folder) :
     return list_of_files
     
 
+def copy_stream_to_temp_file(stream, name, folder, max_bytes=MAX_UPLOAD_FILE_BYTES):
+    """Copy the file object stream chunk by chunk into a new temp file in folder, returning its path.
+
+    Raises RequestEntityTooLarge, leaving nothing behind, once the file
+    named name exceeds max_bytes.
+    """
+    fd, temp_path = tempfile.mkstemp(prefix='.upload_', suffix='.part', dir=dataset_manifest.scratch_folder(folder))
+    try:
+        written = 0
+        with os.fdopen(fd, 'wb') as target:
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK_BYTES)
+                if not chunk:
+                    break
+                written += len(chunk)
+                if written > max_bytes:
+                    raise RequestEntityTooLarge('%s is larger than %s MB' % (name, max_bytes // (1024 * 1024)))
+                target.write(chunk)
+        return temp_path
+    except:
+        os.remove(temp_path)
+        raise
+
+class LimitedUploadFile(tempfile.SpooledTemporaryFile):
+    """File the form parser spools an uploaded file to, keeping at most max_bytes.
+
+    The rest of a larger file is read from the request but not written;
+    oversize is then True and the upload is refused by copy_upload_to_temp_file.
+    """
+
+    def __init__(self, max_bytes=MAX_UPLOAD_FILE_BYTES):
+        super().__init__(max_size=UPLOAD_CHUNK_BYTES, mode='w+b')
+        self.max_bytes = max_bytes
+        self.received = 0
+        self.oversize = False
+
+    def write(self, data):
+        self.received += len(data)
+        if self.received > self.max_bytes:
+            if not self.oversize:
+                self.oversize = True
+                self.truncate(0)
+            return len(data)
+        return super().write(data)
+
+def copy_upload_to_temp_file(fileitem, folder, max_bytes=MAX_UPLOAD_FILE_BYTES):
+    if getattr(fileitem.stream, 'oversize', False):
+        raise RequestEntityTooLarge('%s is larger than %s MB' % (fileitem.filename, fileitem.stream.max_bytes // (1024 * 1024)))
+    return copy_stream_to_temp_file(fileitem.stream, fileitem.filename, folder, max_bytes)
+
+def store_upload(fileitem, final_filename_fullpath, need_convert_image_file):
+    """Write the upload to final_filename_fullpath, converted to png if asked.
+
+    Readers of the folder never see a partial file: everything is written
+    under a temp name and renamed at the end.
+    """
+    folder = os.path.dirname(final_filename_fullpath)
+    temp_path = copy_upload_to_temp_file(fileitem, folder)
+    try:
+        if need_convert_image_file :
+            # Converted from the copy on disk, not from memory.
+            image_conversion.convert_image(temp_path, final_filename_fullpath)
+        else :
+            os.replace(temp_path, final_filename_fullpath)
+    finally :
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def get_stored_image_name(filename) :
+    """(name the uploaded file is stored under, whether it is converted to png)"""
+    # strip the leading path from the file name
+    fn = os.path.basename(filename)
+    fn_lower = fn.lower()
+    #only png, tif is auto supported
+    if  fn_lower.endswith('.bmp') or fn_lower.endswith('.jpg') or fn_lower.endswith('.jpeg') or fn_lower.endswith('.ico')  or fn_lower.endswith('.tiff') :
+        return (fn + '.png', True)
+    return (fn, False)
+
 def save_image_file(username, fileitem) :
     # check if the file has been uploaded
     try :
         final_filename=''
         if fileitem.filename:
-            # strip the leading path from the file name
-            fn = os.path.basename(fileitem.filename)
-            fn_lower = fn.lower()
-            final_filename = fn
-            need_convert_image_file = False 
-            #only png, tif is auto supported
-            if  fn_lower.endswith('.bmp') or fn_lower.endswith('.jpg') or fn_lower.endswith('.jpeg') or fn_lower.endswith('.ico')  or fn_lower.endswith('.tiff') :
-                final_filename =fn + '.png'
-                need_convert_image_file = True
-            final_filename_fullpath = os.path.join(root_path, username, final_filename)
-           # open read and write the file into the server
-            if need_convert_image_file :
-                im = Image.open(fileitem)
-                im.save(final_filename_fullpath)
-            else :
-                open(final_filename_fullpath, 'wb').write(fileitem.read())
+            (final_filename, need_convert_image_file) = get_stored_image_name(fileitem.filename)
+            folder = generate_image_folder(username)
+            final_filename_fullpath = os.path.join(folder, final_filename)
+           # copy the file into the server, without holding it in memory
+            temp_path = copy_upload_to_temp_file(fileitem, folder)
+            try :
+                with dataset_manifest.updating(folder) as manifest :
+                    if need_convert_image_file :
+                        # converted in the background, see image_conversion
+                        image_conversion.submit_conversion(temp_path, final_filename_fullpath)
+                        manifest.touch(final_filename + image_conversion.PENDING_SUFFIX, final_filename + image_conversion.FAILED_SUFFIX)
+                    else :
+                        os.replace(temp_path, final_filename_fullpath)
+                        manifest.touch(final_filename)
+            finally :
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
         temp_messgage =  final_filename + ' saved'
         logger.info(temp_messgage)
         return temp_messgage
@@ -351,27 +503,15 @@ def save_forum_image_file(username, fileitem):
     try :
         final_filename=''
         if fileitem.filename:
-            # strip the leading path from the file name
-            fn = os.path.basename(fileitem.filename)
-            fn_lower = fn.lower()
-            final_filename = fn
-            need_convert_image_file = False 
-            #only png, tif is auto supported
-            if  fn_lower.endswith('.bmp') or fn_lower.endswith('.jpg') or fn_lower.endswith('.jpeg') or fn_lower.endswith('.ico')  or fn_lower.endswith('.tiff') :
-                final_filename =fn + '.png'
-                need_convert_image_file = True
-            
+            (final_filename, need_convert_image_file) = get_stored_image_name(fileitem.filename)
+
             # Create forum subfolder
             forum_folder = os.path.join(root_path, username, 'forum')
             create_folder_if_not_exists(forum_folder)
             
             final_filename_fullpath = os.path.join(forum_folder, final_filename)
-           # open read and write the file into the server
-            if need_convert_image_file :
-                im = Image.open(fileitem)
-                im.save(final_filename_fullpath)
-            else :
-                open(final_filename_fullpath, 'wb').write(fileitem.read())
+           # copy the file into the server, without holding it in memory
+            store_upload(fileitem, final_filename_fullpath, need_convert_image_file)
         temp_messgage =  final_filename + ' saved'
         logger.info(temp_messgage)
         return temp_messgage
@@ -398,6 +538,12 @@ def get_all_template(username ) :
     
    
 def save_image_text(username, image_filename, image_text) :
+    with dataset_manifest.updating(generate_image_folder(username)) as manifest :
+        write_image_text(username, image_filename, image_text)
+        manifest.touch(get_txtfilename_only_from_image(image_filename))
+
+def write_image_text(username, image_filename, image_text) :
+    """save_image_text for callers that hold the manifest lock"""
     final_path = get_txtfilename_from_image(username, image_filename)
     if not image_text : 
         if os.path.exists(final_path):
@@ -421,10 +567,12 @@ def safe_read_image_text(final_path) :
     return ''
 
 def delete_one_image_file(username, image_filename) :
-    final_path = generate_image_fullpath(username, image_filename)
-    logger.info('remove file: ' + final_path)
-    if os.path.exists(final_path):
-        os.remove(final_path)
-    final_path = get_txtfilename_from_image(username, image_filename)
-    if os.path.exists(final_path):
-        os.remove(final_path)
+    with dataset_manifest.updating(generate_image_folder(username)) as manifest :
+        final_path = generate_image_fullpath(username, image_filename)
+        logger.info('remove file: ' + final_path)
+        if os.path.exists(final_path):
+            os.remove(final_path)
+        final_path = get_txtfilename_from_image(username, image_filename)
+        if os.path.exists(final_path):
+            os.remove(final_path)
+        manifest.touch(image_filename, get_txtfilename_only_from_image(image_filename))
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Conversion of uploaded images to png in a pool of processes.
+
+The upload is stored as <final name>.converting and submitted to the pool;
+the pool process writes the png under a temp name, renames it to the final
+name and removes the .converting file, under the lock of the folder's
+dataset_manifest. A conversion that fails leaves
+<final name>.failed with the error instead. Both kinds of files are the
+status shown on the images page, so it is the same for every web worker.
+
+Every web worker process has its own pool, created on the first upload, so
+the pools of all workers together may use the cores at once, next to the
+training jobs. The pool of a worker therefore has CONVERSION_PROCESSES
+processes: by default its share of the cores, cpu_count divided by the
+number of web workers (WEB_CONCURRENCY, as read by gunicorn and uvicorn),
+and at most MAX_DEFAULT_CONVERSION_PROCESSES. Processes are spawned rather
+than forked from the threaded worker.
+
+A .converting file older than STALE_SECONDS may be lost with a restarted
+worker, or just waiting in a busy pool; listing the images submits it again,
+once per process. A conversion holds one of LOCK_STRIPES flocks, chosen by
+the name, and only converts a .converting file it finds there, so the
+second submission of a file waits for the first and then has nothing left
+to do.
+"""
+
+import concurrent.futures
+import fcntl
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+from PIL import Image
+
+from scripts import dataset_manifest
+
+logger = logging.getLogger('MainProgram')
+
+PENDING_SUFFIX = '.converting'
+FAILED_SUFFIX = '.failed'
+STALE_SECONDS = 600
+LOCK_STRIPES = 64
+MAX_DEFAULT_CONVERSION_PROCESSES = 2
+
+
+def _default_conversion_processes():
+    web_workers = max(1, int(os.environ.get('WEB_CONCURRENCY', '1')))
+    return max(1, min(MAX_DEFAULT_CONVERSION_PROCESSES, (os.cpu_count() or 1) // web_workers))
+
+
+CONVERSION_PROCESSES = int(os.environ.get('CONVERSION_PROCESSES', 0)) or _default_conversion_processes()
+
+_pool = None
+_pool_lock = threading.Lock()
+# Final paths submitted by this process and not done yet.
+_submitted = set()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=CONVERSION_PROCESSES, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def pending_path(final_path):
+    return final_path + PENDING_SUFFIX
+
+
+def failed_path(final_path):
+    return final_path + FAILED_SUFFIX
+
+
+def write_png(source_path, final_path):
+    """Save the image at source_path as png in a temp file for final_path, returning its path."""
+    temp_path = os.path.join(dataset_manifest.scratch_folder(os.path.dirname(final_path)),
+                             os.path.basename(final_path) + '.part')
+    try:
+        with Image.open(source_path) as im:
+            im.save(temp_path, format='PNG')
+        return temp_path
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def convert_image(source_path, final_path):
+    """Save the image at source_path as png at final_path, through a temp file."""
+    os.replace(write_png(source_path, final_path), final_path)
+
+
+def _lock_path(folder, final_filename):
+    stripe = int(hashlib.sha1(final_filename.encode('utf-8')).hexdigest(), 16) % LOCK_STRIPES
+    return os.path.join(dataset_manifest.scratch_folder(folder), 'convert-%s.lock' % stripe)
+
+
+def _convert_pending(final_path):
+    """Runs in a pool process. Returns the error message, or None."""
+    (folder, final_filename) = os.path.split(final_path)
+    with open(_lock_path(folder, final_filename), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return _convert_locked(final_path)
+
+
+def _same_file(path, st):
+    try:
+        after = os.stat(path)
+    except FileNotFoundError:
+        return False
+    return (after.st_dev, after.st_ino) == (st.st_dev, st.st_ino)
+
+
+def _convert_locked(final_path):
+    source_path = pending_path(final_path)
+    (folder, final_filename) = os.path.split(final_path)
+    try:
+        st = os.stat(source_path)
+    except FileNotFoundError:
+        # Converted by an earlier submission.
+        return None
+    (temp_path, message) = (None, None)
+    try:
+        temp_path = write_png(source_path, final_path)
+    except Exception as e:
+        # Shown to the user, without the server folders.
+        message = '%s: %s' % (type(e).__name__, str(e).replace(folder + os.sep, ''))
+    with dataset_manifest.updating(folder) as manifest:
+        if not _same_file(source_path, st):
+            # Uploaded again meanwhile; that upload's submission converts it.
+            if temp_path:
+                os.remove(temp_path)
+            return None
+        if temp_path:
+            os.replace(temp_path, final_path)
+        else:
+            with open(failed_path(final_path), 'w', encoding='utf-8') as f:
+                f.write(message)
+        if os.path.exists(source_path):
+            os.remove(source_path)
+        manifest.touch(final_filename, final_filename + PENDING_SUFFIX, final_filename + FAILED_SUFFIX)
+    return message
+
+
+def _log_result(final_path, future):
+    with _pool_lock:
+        _submitted.discard(final_path)
+    try:
+        message = future.result()
+        if message:
+            logger.warning('Converting %s failed: %s' % (final_path, message))
+        else:
+            logger.info('%s converted' % final_path)
+    except Exception as e:
+        logger.exception(e)
+
+
+def submit_conversion(source_path, final_path):
+    """Take over the file at source_path and convert it to final_path in the pool.
+
+    The caller holds the manifest lock and touches the names.
+    """
+    if os.path.exists(failed_path(final_path)):
+        os.remove(failed_path(final_path))
+    os.replace(source_path, pending_path(final_path))
+    _submit(final_path)
+
+
+def _submit(final_path):
+    pool = get_pool()
+    with _pool_lock:
+        _submitted.add(final_path)
+    future = pool.submit(_convert_pending, final_path)
+    future.add_done_callback(lambda f: _log_result(final_path, f))
+
+
+def list_conversions(folder):
+    """(final file name, 'converting' or 'failed', error message) of the conversions in folder."""
+    result = []
+    now = time.time()
+    names = [n for n in dataset_manifest.get_manifest(folder).files if n.endswith((PENDING_SUFFIX, FAILED_SUFFIX))]
+    for name in sorted(names):
+        path = os.path.join(folder, name)
+        if name.endswith(PENDING_SUFFIX):
+            final_path = path[:-len(PENDING_SUFFIX)]
+            try:
+                with _pool_lock:
+                    is_submitted = final_path in _submitted
+                if not is_submitted and now - os.path.getmtime(path) > STALE_SECONDS:
+                    os.utime(path)
+                    _submit(final_path)
+            except OSError:
+                # Finished meanwhile.
+                continue
+            result.append((name[:-len(PENDING_SUFFIX)], 'converting', ''))
+        elif name.endswith(FAILED_SUFFIX):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    message = f.read()
+            except OSError:
+                continue
+            result.append((name[:-len(FAILED_SUFFIX)], 'failed', message))
+    return result
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Tile pyramids of large images for the image editor, which then loads only
+the tiles of the region and zoom level on screen.
+
+Level `levels - 1` is the image at full size, every level below it half the
+size of the one above, down to level 0 which fits in one tile. Level l is
+cut into TILE_SIZE x TILE_SIZE png tiles <l>/<column>_<row>.png (the last
+column and row smaller). The pyramid of an image is made all at once, the
+first time the image is opened in the editor, and kept in
+<user>/cache/tiles/<key> with an info.json; the key is a hash of the image's
+name, size and modification time, so a changed image gets a new pyramid and
+the tiles of a key never change.
+
+Images with no side longer than MIN_TILED_SIDE are shown whole. The folder
+holds at most TILE_CACHE_MAX_BYTES; opening an image refreshes the mtime of
+its pyramid, and after a new pyramid the least recently used ones are
+removed until the folder fits.
+"""
+
+import hashlib
+import json
+import logging
+import math
+import os
+import shutil
+import threading
+import time
+
+from PIL import Image
+from werkzeug.security import safe_join
+
+from scripts import helpers
+
+logger = logging.getLogger('MainProgram')
+
+TILE_SIZE = 256
+MIN_TILED_SIDE = 2048
+TILE_CACHE_MAX_BYTES = int(os.environ.get('TILE_CACHE_MAX_BYTES', 1024 ** 3))
+TOUCH_INTERVAL_SECONDS = 3600
+
+# A lock per pyramid being made, so one image is not tiled twice at once
+# while other images open without waiting.
+_build_locks = {}
+_build_locks_lock = threading.Lock()
+
+
+def generate_tile_folder(username):
+    return os.path.join(helpers.generate_result_folder(username, 'cache'), 'tiles')
+
+
+def pyramid_key(image_filename, stat):
+    text = '%s\0%s\0%s\0%s' % (image_filename, stat.st_size, stat.st_mtime_ns, TILE_SIZE)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _build_pyramid(image_path, target_folder):
+    temp_folder = '%s.tmp%s_%s' % (target_folder, os.getpid(), threading.get_ident())
+    shutil.rmtree(temp_folder, ignore_errors=True)
+    os.makedirs(temp_folder)
+    try:
+        with Image.open(image_path) as im:
+            if im.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+                # Also bilevel and palette images, to be resized by averaging.
+                im = im.convert('L' if im.mode == '1' else 'RGBA' if 'transparency' in im.info else 'RGB')
+            (width, height) = im.size
+            levels = max(0, math.ceil(math.log2(max(width, height) / TILE_SIZE))) + 1
+            level_image = im
+            for level in reversed(range(levels)):
+                level_folder = os.path.join(temp_folder, str(level))
+                os.makedirs(level_folder)
+                (level_width, level_height) = level_image.size
+                for column in range(math.ceil(level_width / TILE_SIZE)):
+                    for row in range(math.ceil(level_height / TILE_SIZE)):
+                        (left, top) = (column * TILE_SIZE, row * TILE_SIZE)
+                        tile = level_image.crop((left, top, min(left + TILE_SIZE, level_width), min(top + TILE_SIZE, level_height)))
+                        tile.save(os.path.join(level_folder, '%s_%s.png' % (column, row)), format='PNG')
+                if level:
+                    level_image = level_image.resize(
+                        (math.ceil(level_width / 2), math.ceil(level_height / 2)), Image.BOX)
+        info = {'width': width, 'height': height, 'tile_size': TILE_SIZE, 'levels': levels}
+        with open(os.path.join(temp_folder, 'info.json'), 'w', encoding='utf-8') as f:
+            json.dump(info, f)
+        os.rename(temp_folder, target_folder)
+    except:
+        shutil.rmtree(temp_folder, ignore_errors=True)
+        raise
+
+
+def get_pyramid(username, image_filename):
+    """info.json of the image's pyramid plus its 'key', made if needed.
+
+    None when the image is small enough to be shown whole, or is not an image.
+    """
+    image_path = safe_join(helpers.generate_image_folder(username), image_filename)
+    if not image_path or not os.path.isfile(image_path):
+        return None
+    try:
+        with Image.open(image_path) as im:
+            if max(im.size) <= MIN_TILED_SIDE:
+                return None
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    key = pyramid_key(image_filename, os.stat(image_path))
+    tile_folder = generate_tile_folder(username)
+    pyramid_folder = os.path.join(tile_folder, key)
+    info_path = os.path.join(pyramid_folder, 'info.json')
+    if os.path.exists(info_path):
+        if time.time() - os.path.getmtime(pyramid_folder) > TOUCH_INTERVAL_SECONDS:
+            os.utime(pyramid_folder)
+    elif not _make_pyramid(key, image_path, tile_folder, pyramid_folder):
+        return None
+    with open(info_path, 'r', encoding='utf-8') as f:
+        info = json.load(f)
+    info['key'] = key
+    return info
+
+
+def _make_pyramid(key, image_path, tile_folder, pyramid_folder):
+    """Make the pyramid unless another thread did meanwhile; False when the image cannot be tiled."""
+    with _build_locks_lock:
+        build_lock = _build_locks.setdefault(key, threading.Lock())
+    with build_lock:
+        try:
+            if os.path.exists(os.path.join(pyramid_folder, 'info.json')):
+                return True
+            helpers.create_folder_if_not_exists(tile_folder)
+            started = time.time()
+            try:
+                _build_pyramid(image_path, pyramid_folder)
+            except (OSError, ValueError, Image.DecompressionBombError) as e:
+                logger.warning('No tiles of %s: %s' % (image_path, e))
+                return False
+            logger.info('Tiles of %s made in %.1f s' % (image_path, time.time() - started))
+        finally:
+            with _build_locks_lock:
+                _build_locks.pop(key, None)
+    evict_pyramids(tile_folder)
+    return True
+
+
+def get_tile_path(username, key, level, column, row):
+    """Path of a tile of a pyramid made by get_pyramid, or None."""
+    tile_path = safe_join(generate_tile_folder(username), key, str(level), '%s_%s.png' % (column, row))
+    if not tile_path or not os.path.isfile(tile_path):
+        return None
+    return tile_path
+
+
+def _folder_size(folder):
+    total = 0
+    for dirpath, _, filenames in os.walk(folder):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass
+    return total
+
+
+def evict_pyramids(tile_folder, max_bytes=TILE_CACHE_MAX_BYTES):
+    """Remove least recently used pyramids until the folder fits in max_bytes."""
+    entries = []
+    for name in os.listdir(tile_folder):
+        path = os.path.join(tile_folder, name)
+        if os.path.isdir(path) and '.tmp' not in name:
+            entries.append((os.path.getmtime(path), _folder_size(path), path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
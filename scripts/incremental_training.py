@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental fine-tuning from a previous result.
+
+Every finished job writes results/<model>/training_manifest.json with the
+ground truth cache keys (see training_cache) of all pairs the model has been
+trained on. A job that continues from that result starts from its
+.traineddata, or converts its last checkpoint when the .traineddata was
+already cleaned up. It trains only on pairs whose key is not in the manifest,
+plus a random replay sample of the old pairs so the model does not forget
+them.
+"""
+
+import json
+import math
+import os
+import random
+import shutil
+
+from scripts import helpers
+
+MANIFEST_FILENAME = 'training_manifest.json'
+DEFAULT_REPLAY_PERCENT = 10
+# tesstrain splits the lines into training and evaluation, it needs a few.
+MIN_TRAINING_PAIRS = 2
+
+
+def generate_previous_model_name(continue_from):
+    """START_MODEL name of the previous result inside the job's tessdata folder."""
+    return 'previous_' + continue_from
+
+
+def _result_paths(username, model_name):
+    result_dir = helpers.generate_result_folder(username, 'results')
+    model_dir = os.path.join(result_dir, model_name)
+    return {
+        'traineddata': os.path.join(result_dir, model_name + '.traineddata'),
+        'checkpoint': os.path.join(model_dir, 'checkpoints', model_name + '_checkpoint'),
+        'proto': os.path.join(model_dir, model_name + '.traineddata'),
+        'manifest': os.path.join(model_dir, MANIFEST_FILENAME),
+    }
+
+
+def list_previous_results(username):
+    """Model names in results/ that a new job can continue from."""
+    result_dir = helpers.generate_result_folder(username, 'results')
+    if not os.path.isdir(result_dir):
+        return []
+    names = set()
+    for entry in os.listdir(result_dir):
+        name = entry[:-len('.traineddata')] if entry.endswith('.traineddata') else entry
+        paths = _result_paths(username, name)
+        if os.path.isfile(paths['traineddata']) or (os.path.isfile(paths['checkpoint']) and os.path.isfile(paths['proto'])):
+            names.add(name)
+    return sorted(names)
+
+
+def read_manifest(manifest_path):
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return set(json.load(f).get('keys', []))
+    except (OSError, ValueError):
+        return set()
+
+
+def write_manifest(manifest_path, keys, continue_from=''):
+    helpers.create_folder_if_not_exists(os.path.dirname(manifest_path))
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump({'continue_from': continue_from, 'keys': sorted(keys)}, f)
+
+
+def prepare_previous_model(username, continue_from, tessdata_dir):
+    """Copy what is needed from results/<continue_from> into the job's tessdata folder.
+
+    Must run before the results folder of a job with the same model name is
+    moved aside. Returns a dict with the previous manifest keys and either
+    the copied .traineddata or the copied checkpoint and proto model that the
+    training command converts first.
+    """
+    paths = _result_paths(username, continue_from)
+    helpers.create_folder_if_not_exists(tessdata_dir)
+    start_model_name = generate_previous_model_name(continue_from)
+    previous = {
+        'start_model': start_model_name,
+        'keys': read_manifest(paths['manifest']),
+        'traineddata': os.path.join(tessdata_dir, start_model_name + '.traineddata'),
+        'checkpoint': None,
+        'proto': None,
+    }
+    if os.path.isfile(paths['traineddata']):
+        shutil.copyfile(paths['traineddata'], previous['traineddata'])
+    elif os.path.isfile(paths['checkpoint']) and os.path.isfile(paths['proto']):
+        previous['checkpoint'] = os.path.join(tessdata_dir, start_model_name + '_checkpoint')
+        previous['proto'] = os.path.join(tessdata_dir, start_model_name + '_proto.traineddata')
+        shutil.copyfile(paths['checkpoint'], previous['checkpoint'])
+        shutil.copyfile(paths['proto'], previous['proto'])
+    else:
+        raise Exception('Cannot continue from %s: neither %s.traineddata nor its last checkpoint exists any more' % (continue_from, continue_from))
+    return previous
+
+
+def build_checkpoint_conversion_command(previous):
+    """lstmtraining call turning the previous checkpoint into the start .traineddata, or ''."""
+    if not previous or not previous['checkpoint']:
+        return ''
+    return 'lstmtraining --stop_training --continue_from %s --traineddata %s --model_output %s' % (
+        previous['checkpoint'], previous['proto'], previous['traineddata'])
+
+
+def select_incremental_pairs(keyed_pairs, previous_keys, replay_percent, seed=None):
+    """Pick the new pairs plus replay_percent of the already trained ones.
+
+    Returns (selected keyed pairs, number of new pairs, number replayed).
+    """
+    new_pairs = [pair for pair in keyed_pairs if pair[2] not in previous_keys]
+    old_pairs = [pair for pair in keyed_pairs if pair[2] in previous_keys]
+    replay_count = int(math.ceil(len(old_pairs) * max(0, min(100, replay_percent)) / 100.0))
+    replay_count = min(len(old_pairs), max(replay_count, MIN_TRAINING_PAIRS - len(new_pairs)))
+    replay_pairs = random.Random(seed).sample(old_pairs, replay_count)
+    selected = sorted(new_pairs + replay_pairs)
+    return selected, len(new_pairs), len(replay_pairs)
+
+
+def manifest_path_for_result(username, model_name):
+    return _result_paths(username, model_name)['manifest']
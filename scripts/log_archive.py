@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Compressed, indexed storage for finished training logs.
+
+A log that no job writes any more is replaced by log_<time>.log.gz: the log
+cut into blocks of about BLOCK_BYTES at line ends, each block compressed as
+its own gzip member. The members follow each other, so the file is still an
+ordinary .gz for download and gunzip. Next to it, log_<time>.log.gz.idx
+lists per block
+
+    [first line number, offset in the log, offset in the .gz, compressed length]
+
+so a range of lines is read by decompressing only the blocks it lies in.
+
+The training runner archives the logs in the background once they were not
+written for ARCHIVE_AFTER_SECONDS.
+"""
+
+import bisect
+import glob
+import gzip
+import json
+import logging
+import os
+import time
+import zlib
+
+from scripts import helpers
+
+logger = logging.getLogger('MainProgram')
+
+ARCHIVE_SUFFIX = '.gz'
+INDEX_SUFFIX = '.idx'
+BLOCK_BYTES = 64 * 1024
+# Logs not modified for this long are archived; a finished job's page can
+# still follow the plain log until then.
+ARCHIVE_AFTER_SECONDS = 600
+
+
+def archive_path(log_path):
+    return log_path + ARCHIVE_SUFFIX
+
+
+def index_path(log_path):
+    return archive_path(log_path) + INDEX_SUFFIX
+
+
+def original_path(path):
+    """The plain log path for a log or its archive."""
+    if path.endswith(ARCHIVE_SUFFIX):
+        return path[:-len(ARCHIVE_SUFFIX)]
+    return path
+
+
+def is_archived(log_path):
+    return not os.path.isfile(log_path) and os.path.isfile(index_path(log_path))
+
+
+def _count_lines(data):
+    return data.count(b'\n') + (1 if data and not data.endswith(b'\n') else 0)
+
+
+def _split_lines(data):
+    lines = data.decode('utf-8', errors='replace').split('\n')
+    if lines and lines[-1] == '':
+        lines.pop()
+    return lines
+
+
+def archive_log(log_path):
+    """Replace the log by its archive and index. Returns the archive path."""
+    gz_path = archive_path(log_path)
+    idx_path = index_path(log_path)
+    blocks = []
+    line_count = 0
+    raw_offset = 0
+    with open(log_path, 'rb') as source, open(gz_path + '.tmp', 'wb') as target:
+        rest = b''
+        while True:
+            data = source.read(BLOCK_BYTES)
+            block = rest + data
+            if data:
+                cut = block.rfind(b'\n') + 1
+                if cut == 0:
+                    # A block holds whole lines, also a line longer than BLOCK_BYTES.
+                    rest = block
+                    continue
+                (block, rest) = (block[:cut], block[cut:])
+            if not block:
+                break
+            compressed = gzip.compress(block, mtime=0)
+            blocks.append([line_count, raw_offset, target.tell(), len(compressed)])
+            target.write(compressed)
+            line_count += _count_lines(block)
+            raw_offset += len(block)
+            if not data:
+                break
+    index = {'lines': line_count, 'size': raw_offset, 'block_bytes': BLOCK_BYTES, 'blocks': blocks}
+    with open(idx_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(index, f, separators=(',', ':'))
+    os.replace(gz_path + '.tmp', gz_path)
+    os.replace(idx_path + '.tmp', idx_path)
+    os.remove(log_path)
+    return gz_path
+
+
+def read_index(log_path):
+    with open(index_path(log_path), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _read_block(f, block):
+    f.seek(block[2])
+    return zlib.decompress(f.read(block[3]), 16 + zlib.MAX_WBITS)
+
+
+def read_archived_lines(log_path, start, count):
+    """(lines start to start + count, total line count) of an archived log."""
+    index = read_index(log_path)
+    blocks = index['blocks']
+    lines = []
+    position = max(0, bisect.bisect_right([b[0] for b in blocks], start) - 1)
+    with open(archive_path(log_path), 'rb') as f:
+        while position < len(blocks) and len(lines) < count:
+            block = blocks[position]
+            skip = max(0, start - block[0])
+            lines.extend(_split_lines(_read_block(f, block))[skip:skip + count - len(lines)])
+            position += 1
+    return lines, index['lines']
+
+
+def read_archived_tail(log_path, count):
+    """(last count lines, total line count) of an archived log."""
+    total = read_index(log_path)['lines']
+    return read_archived_lines(log_path, max(0, total - count), count)
+
+
+def iter_archived_chunks(log_path, offset=0):
+    """Yield (offset after text, text) of an archived log from byte offset on, one block at a time."""
+    blocks = read_index(log_path)['blocks']
+    first = max(0, bisect.bisect_right([b[1] for b in blocks], offset) - 1)
+    with open(archive_path(log_path), 'rb') as f:
+        for block in blocks[first:]:
+            data = _read_block(f, block)
+            end = block[1] + len(data)
+            if end <= offset:
+                continue
+            data = data[max(0, offset - block[1]):]
+            yield end, data.decode('utf-8', errors='replace')
+
+
+def archive_finished_logs(active_log_paths, min_age=ARCHIVE_AFTER_SECONDS):
+    """Archive the logs in every user's logs folder that are not in active_log_paths and are idle for min_age."""
+    active = set(os.path.abspath(p) for p in active_log_paths if p)
+    now = time.time()
+    archived = 0
+    for log_path in glob.glob(os.path.join(helpers.root_path, '*', 'logs', '*.log')):
+        try:
+            if os.path.abspath(log_path) in active or now - os.path.getmtime(log_path) < min_age:
+                continue
+            archive_log(log_path)
+            archived += 1
+        except Exception as e:
+            logger.exception(e)
+    if archived:
+        logger.info('Archived %s training logs' % archived)
+    return archived
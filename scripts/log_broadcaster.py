@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+One reader per log file, shared by all clients following it.
+
+subscribe(path) returns a Subscription that yields the log from its start,
+or from a given byte offset, and then follows it, like LogTailer. Within a process, the first subscriber
+of a file starts a LogBroadcaster thread that tails the file once and puts
+every new chunk into the bounded queue of each subscriber. A subscriber
+reads the part written before it joined from the file itself.
+
+A subscriber whose queue is full (a slow client) is dropped instead of
+holding up the others; its iteration ends with dropped set, and the client
+can reconnect. The thread stops when the log is finished or nobody follows
+it any more.
+"""
+
+import logging
+import os
+import queue
+import threading
+
+from scripts.log_tailer import LogTailer, MAX_CHUNK_BYTES, DEFAULT_KEEP_ALIVE_SECONDS
+
+logger = logging.getLogger('MainProgram')
+
+# Chunks buffered per subscriber before it counts as too slow.
+SUBSCRIBER_QUEUE_SIZE = 64
+# How often an idle broadcaster checks whether it still has subscribers.
+IDLE_CHECK_SECONDS = 1
+
+_END = object()
+_DROPPED = object()
+
+_broadcasters = {}
+_broadcasters_lock = threading.Lock()
+
+
+def last_line_end(path):
+    """Offset just after the last complete line of the file."""
+    with open(path, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+        position = size
+        while position > 0:
+            start = max(0, position - MAX_CHUNK_BYTES)
+            f.seek(start)
+            data = f.read(position - start)
+            newline = data.rfind(b'\n')
+            if newline >= 0:
+                return start + newline + 1
+            position = start
+        return 0
+
+
+def read_range(path, start, end):
+    """Yield (offset, text) chunks of the file between start and end, cut at line ends."""
+    with open(path, 'rb') as f:
+        offset = start
+        while offset < end:
+            f.seek(offset)
+            data = f.read(min(MAX_CHUNK_BYTES, end - offset))
+            if not data:
+                return
+            cut = data.rfind(b'\n') + 1
+            if cut and offset + len(data) < end:
+                data = data[:cut]
+            offset += len(data)
+            yield offset, data.decode('utf-8', errors='replace')
+
+
+class Subscription:
+    """Iterate over the log: the backlog first, then the chunks of the broadcaster."""
+
+    def __init__(self, broadcaster, start_offset, keep_alive, resume_offset=0):
+        self.broadcaster = broadcaster
+        self.start_offset = start_offset
+        self.keep_alive = keep_alive
+        self.resume_offset = resume_offset
+        self.queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.dropped = False
+
+    def __iter__(self):
+        try:
+            for chunk in read_range(self.broadcaster.path, self.resume_offset, self.start_offset):
+                yield chunk
+            offset = max(self.start_offset, self.resume_offset)
+            while True:
+                try:
+                    item = self.queue.get(timeout=self.keep_alive)
+                except queue.Empty:
+                    yield offset, None
+                    continue
+                if item is _END:
+                    return
+                if item is _DROPPED:
+                    self.dropped = True
+                    return
+                if item[0] <= offset:
+                    # Already sent before a reconnect.
+                    continue
+                offset = item[0]
+                yield item
+        finally:
+            self.broadcaster.unsubscribe(self)
+
+
+class LogBroadcaster:
+    """Tail one file in a thread and fan its chunks out to the subscribers."""
+
+    def __init__(self, path, is_finished=None):
+        self.path = path
+        self.is_finished = is_finished
+        self.offset = last_line_end(path)
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='log-broadcaster', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def subscribe(self, keep_alive=DEFAULT_KEEP_ALIVE_SECONDS, resume_offset=0):
+        """A new Subscription, or None when the broadcaster has already stopped."""
+        with self._lock:
+            if self._stopped:
+                return None
+            subscription = Subscription(self, self.offset, keep_alive, resume_offset)
+            self._subscribers.add(subscription)
+            return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def _publish(self, item, offset=None):
+        # Under the same lock as subscribe, so a new subscriber either reads
+        # a chunk from the file or gets it queued, never both.
+        with self._lock:
+            if offset is not None:
+                self.offset = offset
+            for subscription in list(self._subscribers):
+                try:
+                    subscription.queue.put_nowait(item)
+                except queue.Full:
+                    # Make room for the notice, the subscriber gets nothing else.
+                    logger.info('Dropping a slow client of %s' % self.path)
+                    self._subscribers.discard(subscription)
+                    with subscription.queue.mutex:
+                        subscription.queue.queue.clear()
+                    subscription.queue.put_nowait(_DROPPED)
+
+    def _has_subscribers(self):
+        with self._lock:
+            return bool(self._subscribers)
+
+    def _run(self):
+        try:
+            tailer = LogTailer(self.path, offset=self.offset, is_finished=self.is_finished,
+                               keep_alive=IDLE_CHECK_SECONDS)
+            for offset, text in tailer:
+                if text is not None:
+                    self._publish((offset, text), offset)
+                if not self._has_subscribers():
+                    tailer.close()
+                    break
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            with _broadcasters_lock:
+                if _broadcasters.get(self.path) is self:
+                    del _broadcasters[self.path]
+            with self._lock:
+                self._stopped = True
+            self._publish(_END)
+
+
+def subscribe(path, is_finished=None, keep_alive=DEFAULT_KEEP_ALIVE_SECONDS, offset=0):
+    """Subscription to the log at path from byte offset on, starting a broadcaster for it if needed.
+
+    is_finished is used by the broadcaster the first subscriber starts, see
+    LogTailer. Without it, the broadcaster stops at the end of the file. An
+    offset beyond the end of the file starts at the end.
+    """
+    path = os.path.abspath(path)
+    offset = max(0, min(offset, os.path.getsize(path)))
+    while True:
+        with _broadcasters_lock:
+            broadcaster = _broadcasters.get(path)
+            if broadcaster is None:
+                broadcaster = LogBroadcaster(path, is_finished)
+                _broadcasters[path] = broadcaster
+                subscription = broadcaster.subscribe(keep_alive, offset)
+                broadcaster.start()
+                return subscription
+        subscription = broadcaster.subscribe(keep_alive, offset)
+        if subscription is not None:
+            return subscription
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Follow a growing log file.
+
+LogTailer waits for new data with inotify where the kernel has it and falls
+back to polling with a backoff (POLL_MIN_SECONDS up to POLL_MAX_SECONDS)
+elsewhere. New bytes are read in bulk and handed out in batches: after the
+first change it keeps collecting for flush_interval seconds, so a burst of
+thousands of lines becomes one chunk and an idle log costs one wakeup per
+keep-alive.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import time
+
+logger = logging.getLogger('MainProgram')
+
+POLL_MIN_SECONDS = 0.05
+POLL_MAX_SECONDS = 1.0
+DEFAULT_FLUSH_INTERVAL_SECONDS = 0.5
+DEFAULT_KEEP_ALIVE_SECONDS = 15
+# Bytes handed out per chunk at most; a longer backlog follows in the next ones.
+MAX_CHUNK_BYTES = 256 * 1024
+
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVE_SELF = 0x00000800
+_IN_DELETE_SELF = 0x00000400
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_WATCH_MASK = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVE_SELF | _IN_DELETE_SELF
+
+_libc = None
+
+
+def _get_libc():
+    """libc with inotify, or None (not Linux, or no ctypes support)."""
+    global _libc
+    if _libc is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            libc.inotify_init1
+            libc.inotify_add_watch
+            _libc = libc
+        except (OSError, AttributeError):
+            _libc = False
+    return _libc or None
+
+
+def read_lines(f, offset, limit, partial=False):
+    """Lines of the open binary file f after offset, at most limit bytes unless a single line is longer.
+
+    An unfinished last line is left for later unless partial is True.
+    """
+    f.seek(offset)
+    data = f.read(limit)
+    if partial or len(data) == limit:
+        end = data.rfind(b'\n') + 1 or len(data)
+    else:
+        end = data.rfind(b'\n') + 1
+    return data[:end]
+
+
+class InotifyWatch:
+    """Minimal inotify watch on one file; fd becomes readable when it changed."""
+
+    def __init__(self, path):
+        libc = _get_libc()
+        if libc is None:
+            raise OSError('inotify is not available')
+        self.fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), _WATCH_MASK) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, 'inotify_add_watch failed for %s' % path)
+
+    def drain(self):
+        """Discard the queued events; which one it was does not matter."""
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def wait(self, timeout):
+        """Block until the file changed or timeout passed. True on a change."""
+        (readable, _, _) = select.select([self.fd], [], [], max(0, timeout))
+        if not readable:
+            return False
+        self.drain()
+        return True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class LogTailer:
+    """Iterate over the new content of a file, see the module docstring.
+
+    Yields (offset, text) with the byte offset after text, or (offset, None)
+    as keep-alive when nothing was written for keep_alive seconds. An
+    unfinished last line is held back until the writer is done. Iteration
+    ends once is_finished() returns True and the file was read to its end,
+    or immediately at the end of the file when is_finished is None.
+    """
+
+    def __init__(self, path, offset=0, is_finished=None,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL_SECONDS, keep_alive=DEFAULT_KEEP_ALIVE_SECONDS):
+        self.path = path
+        self.offset = offset
+        self.is_finished = is_finished
+        self.flush_interval = flush_interval
+        self.keep_alive = keep_alive
+        self._file = None
+        self._watch = None
+        self._poll_delay = POLL_MIN_SECONDS
+
+    def _open(self):
+        self._file = open(self.path, 'rb')
+        try:
+            self._watch = InotifyWatch(self.path)
+        except OSError as e:
+            logger.debug('Polling %s: %s' % (self.path, e))
+            self._watch = None
+
+    def close(self):
+        if self._watch:
+            self._watch.close()
+            self._watch = None
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _read_lines(self, limit, partial=False):
+        return read_lines(self._file, self.offset, limit, partial)
+
+    def _wait(self, timeout):
+        """Wait for the file to change; with polling, back off while nothing happens."""
+        if self._watch:
+            return self._watch.wait(timeout)
+        delay = min(self._poll_delay, timeout)
+        size_before = os.fstat(self._file.fileno()).st_size
+        time.sleep(max(0, delay))
+        changed = os.fstat(self._file.fileno()).st_size != size_before
+        self._poll_delay = POLL_MIN_SECONDS if changed else min(self._poll_delay * 2, POLL_MAX_SECONDS)
+        return changed
+
+    def _chunk(self, data):
+        self.offset += len(data)
+        return self.offset, data.decode('utf-8', errors='replace')
+
+    def __iter__(self):
+        self._open()
+        try:
+            last_output = time.monotonic()
+            while True:
+                data = self._read_lines(MAX_CHUNK_BYTES)
+                if data:
+                    last_output = time.monotonic()
+                    yield self._chunk(data)
+                    continue
+                if self.is_finished is None or self.is_finished():
+                    # The writer is done, hand out what it wrote meanwhile.
+                    data = self._read_lines(MAX_CHUNK_BYTES, partial=True)
+                    while data:
+                        yield self._chunk(data)
+                        data = self._read_lines(MAX_CHUNK_BYTES, partial=True)
+                    return
+                timeout = self.keep_alive - (time.monotonic() - last_output)
+                if timeout <= 0:
+                    last_output = time.monotonic()
+                    yield self.offset, None
+                elif self._wait(min(timeout, POLL_MAX_SECONDS)):
+                    # Give the writer flush_interval to add more before the
+                    # batch goes out.
+                    time.sleep(self.flush_interval)
+        finally:
+            self.close()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Logging that keeps file I/O off the request threads.
+
+setup_queue_logging puts a QueueHandler on the logger: logging a record only
+appends it to an in-memory queue. A QueueListener thread per process takes
+the records from there and formats, writes and rotates them.
+
+Several gunicorn workers write the same log file. SharedRotatingFileHandler
+rotates it under an flock on <log file>.lock, so only one process renames
+the files at a time. A process whose file was rotated by another one
+reopens the new file instead of writing on into the backup.
+
+The listener thread is started at import of the app, so every worker has its
+own; with gunicorn --preload it would only run in the master.
+"""
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_MAX_BYTES = 2000000
+LOG_BACKUP_COUNT = 50
+
+
+class SharedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """RotatingFileHandler for a file written by several processes, see the module docstring."""
+
+    def __init__(self, filename, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT):
+        super().__init__(filename, maxBytes=maxBytes, backupCount=backupCount, delay=True)
+        # Opened right away so a missing log folder fails at startup.
+        self._lock_file = open(self.baseFilename + '.lock', 'a') if fcntl else None
+
+    def _reopen_if_rotated(self):
+        if self.stream is None:
+            return
+        try:
+            rotated = os.stat(self.baseFilename).st_ino != os.fstat(self.stream.fileno()).st_ino
+        except FileNotFoundError:
+            rotated = True
+        if rotated:
+            self.stream.close()
+            self.stream = None
+
+    def emit(self, record):
+        try:
+            if self._lock_file:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                self._reopen_if_rotated()
+                if self.shouldRollover(record):
+                    self.doRollover()
+                logging.FileHandler.emit(self, record)
+            finally:
+                if self._lock_file:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        super().close()
+        if self._lock_file:
+            self._lock_file.close()
+            self._lock_file = None
+
+
+def setup_queue_logging(logger, handlers, level=logging.INFO):
+    """Log through a queue to handlers, which get the usual format and level. Returns the started QueueListener."""
+    formatter = logging.Formatter(LOG_FORMAT)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+        handler.setLevel(level)
+    log_queue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(level)
+    listener.start()
+    # Writes what is still queued at exit.
+    atexit.register(listener.stop)
+    return listener
@@ -76,5 +76,45 @@ class ForumReply(Base):
         return '<ForumReply %r>' % self.id
 
 
+class TrainingJob(Base):
+    __tablename__ = "training_job"
+
+    id = Column(Integer, primary_key=True)
+    username = Column(String(30), nullable=False, index=True)
+    model_name = Column(String(255), nullable=False)
+    start_template = Column(String(255), nullable=True)
+    more_parameters = Column(Text, nullable=True)
+    continue_from = Column(String(255), nullable=True)
+    replay_percent = Column(Integer, nullable=True)
+    early_stop_checkpoints = Column(Integer, nullable=True)
+    log_filename = Column(String(512), nullable=False)
+    status = Column(String(20), nullable=False, default='queued', index=True)
+    message = Column(Text, nullable=True)
+    created_at = Column(DateTime, nullable=False, default=datetime.now)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    runner_pid = Column(Integer, nullable=True)
+    process_pid = Column(Integer, nullable=True)
+    process_group_id = Column(Integer, nullable=True)
+
+    def __repr__(self):
+        return '<TrainingJob %r %r>' % (self.id, self.status)
+
+
+class TrainingRunner(Base):
+    """Single row describing the training runner process that owns the queue."""
+    __tablename__ = "training_runner"
+
+    id = Column(Integer, primary_key=True)
+    pid = Column(Integer, nullable=True)
+    hostname = Column(String(255), nullable=True)
+    slot_count = Column(Integer, nullable=True)
+    started_at = Column(DateTime, nullable=True)
+    heartbeat_at = Column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return '<TrainingRunner %r>' % self.pid
+
+
 engine = db_connect()  # Connect to database
 Base.metadata.create_all(engine)  # Create models
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Thumbnails of the user's images, shown on the images page instead of the
+originals.
+
+A thumbnail is made on its first request and kept in <user>/cache/thumbnails
+as png, named after a hash of the image's name, size and modification time:
+a changed image gets a new thumbnail and the old one is no longer used.
+
+The folder holds at most THUMBNAIL_CACHE_MAX_BYTES. Serving a thumbnail
+refreshes its mtime (at most every TOUCH_INTERVAL_SECONDS), and after every
+EVICT_EVERY new thumbnails the least recently used ones are removed until
+the folder fits again.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from PIL import Image
+from werkzeug.security import safe_join
+
+from scripts import helpers
+
+logger = logging.getLogger('MainProgram')
+
+THUMBNAIL_SIZE = (400, 100)
+THUMBNAIL_CACHE_MAX_BYTES = int(os.environ.get('THUMBNAIL_CACHE_MAX_BYTES', 256 * 1024 ** 2))
+TOUCH_INTERVAL_SECONDS = 3600
+EVICT_EVERY = 100
+
+_new_thumbnails = {}
+_new_thumbnails_lock = threading.Lock()
+
+
+def generate_thumbnail_folder(username):
+    return os.path.join(helpers.generate_result_folder(username, 'cache'), 'thumbnails')
+
+
+def thumbnail_key(image_filename, stat):
+    text = '%s\0%s\0%s\0%sx%s' % ((image_filename, stat.st_size, stat.st_mtime_ns) + THUMBNAIL_SIZE)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def make_thumbnail(image_path, thumbnail_path):
+    """Save a png of at most THUMBNAIL_SIZE of the image, through a temp file."""
+    temp_path = '%s.tmp%s_%s' % (thumbnail_path, os.getpid(), threading.get_ident())
+    try:
+        with Image.open(image_path) as im:
+            if im.mode not in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA'):
+                # 16 bit and CMYK tiffs, which png or resizing do not take.
+                im = im.convert('RGB')
+            im.thumbnail(THUMBNAIL_SIZE)
+            im.save(temp_path, format='PNG')
+        os.replace(temp_path, thumbnail_path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def get_thumbnail(username, image_filename):
+    """Path of the thumbnail of the user's image, made if needed; None when there is no such image."""
+    image_path = safe_join(helpers.generate_image_folder(username), image_filename)
+    if not image_path or not os.path.isfile(image_path):
+        return None
+    folder = generate_thumbnail_folder(username)
+    thumbnail_path = os.path.join(folder, thumbnail_key(image_filename, os.stat(image_path)) + '.png')
+    try:
+        if time.time() - os.path.getmtime(thumbnail_path) > TOUCH_INTERVAL_SECONDS:
+            os.utime(thumbnail_path)
+        return thumbnail_path
+    except FileNotFoundError:
+        pass
+    helpers.create_folder_if_not_exists(folder)
+    try:
+        make_thumbnail(image_path, thumbnail_path)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logger.warning('No thumbnail of %s: %s' % (image_path, e))
+        return None
+    with _new_thumbnails_lock:
+        count = _new_thumbnails.get(folder, 0) + 1
+        _new_thumbnails[folder] = count % EVICT_EVERY
+    if count == EVICT_EVERY:
+        evict_thumbnails(folder)
+    return thumbnail_path
+
+
+def evict_thumbnails(folder, max_bytes=THUMBNAIL_CACHE_MAX_BYTES):
+    """Remove least recently used thumbnails until the folder fits in max_bytes."""
+    entries = []
+    with os.scandir(folder) as it:
+        for entry in it:
+            if entry.name.endswith('.png') and entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
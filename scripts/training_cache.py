@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""
+Caches of files tesstrain derives from the ground truth and the start model.
+
+tesstrain turns every image + .gt.txt pair into a .box and a .lstmf file.
+These only depend on the pair's content and a few settings, so they are kept
+per user in <user>/cache/ground-truth, named after a hash of (image sha256,
+text sha256, settings). The sha256 of the files come from the
+dataset_manifest, which keeps them per file size and mtime, so a job only
+reads the pairs that are new or changed since they were last hashed.
+Before a job starts, the cached files of unchanged pairs are copied into
+the job's ground truth folder so make skips them. After a job whose make
+got past the .lstmf files (completed or stopped early), newly generated
+files are added to the cache.
+
+With START_MODEL, tesstrain unpacks the template .traineddata into
+$(DATA_DIR)/$(START_MODEL), merges its unicharset with the dataset's and
+builds a proto model. The unpacked components only depend on the template
+file; the unicharset and proto model also depend on the set of characters
+in the ground truth. Both are kept in <tesstrain>/cache/start-models, shared
+by all users and evicted least recently used first.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+from scripts import dataset_manifest
+from scripts import helpers
+
+logger = logging.getLogger('MainProgram')
+
+# make variables that change the generated .box / .lstmf files.
+GROUND_TRUTH_SETTING_KEYS = ('PSM', 'GENERATE_BOX_SCRIPT')
+GROUND_TRUTH_CACHE_EXTENSIONS = ('.box', '.lstmf')
+# Cached files unused for this long are removed after a job.
+GROUND_TRUTH_CACHE_MAX_AGE_DAYS = 30
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def parse_make_variables(more_parameters):
+    """Return the KEY=VALUE pairs of the additional make options as a dict."""
+    variables = {}
+    for token in (more_parameters or '').split():
+        if '=' in token:
+            key, value = token.split('=', 1)
+            if key:
+                variables[key] = value
+    return variables
+
+
+def ground_truth_settings(more_parameters):
+    variables = parse_make_variables(more_parameters)
+    return ';'.join('%s=%s' % (key, variables.get(key, '')) for key in GROUND_TRUTH_SETTING_KEYS)
+
+
+def hash_file(file_path, digest=None):
+    digest = digest or hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest
+
+
+def ground_truth_key(image_hash, text_hash, settings):
+    """Cache key of a pair from the sha256 of its image and text files."""
+    text = '%s\0%s\0%s' % (image_hash, text_hash, settings)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def generate_ground_truth_cache_folder(username):
+    return os.path.join(helpers.generate_result_folder(username, 'cache'), 'ground-truth')
+
+
+def _cache_path(cache_folder, key, extension):
+    return os.path.join(cache_folder, key[:2], key + extension)
+
+
+def link_or_copy(source, target):
+    """Hard link source to target, copying when a link is not possible."""
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def ground_truth_keys(username, pairs, more_parameters):
+    """Return (image filename, text filename, cache key) for every pair."""
+    image_folder = helpers.generate_image_folder(username)
+    settings = ground_truth_settings(more_parameters)
+    hashes = dataset_manifest.get_file_hashes(image_folder, [name for pair in pairs for name in pair])
+
+    def file_hash(filename):
+        # Not in hashes when it changed while it was hashed.
+        return hashes.get(filename) or hash_file(os.path.join(image_folder, filename)).hexdigest()
+
+    return [
+        (image_filename, text_filename, ground_truth_key(file_hash(image_filename), file_hash(text_filename), settings))
+        for (image_filename, text_filename) in pairs
+    ]
+
+
+def prepare_ground_truth(username, keyed_pairs, ground_truth_dir):
+    """Fill the job's ground truth folder and reuse cached .box/.lstmf files.
+
+    keyed_pairs comes from ground_truth_keys. Images are hard linked; the
+    small .gt.txt files are copied so editing a text while the job runs
+    cannot change the job's input. Returns a list of (file stem, cache key)
+    and the number of pairs taken from the cache.
+    """
+    image_folder = helpers.generate_image_folder(username)
+    cache_folder = generate_ground_truth_cache_folder(username)
+    helpers.create_folder_if_not_exists(ground_truth_dir)
+    entries = []
+    reused = 0
+    for (image_filename, text_filename, key) in keyed_pairs:
+        image_path = os.path.join(image_folder, image_filename)
+        text_path = os.path.join(image_folder, text_filename)
+        link_or_copy(image_path, os.path.join(ground_truth_dir, image_filename))
+        stem = image_filename[:-4]
+        # copy2 keeps the original mtime, older than anything make derives from it.
+        shutil.copy2(text_path, os.path.join(ground_truth_dir, stem + '.gt.txt'))
+        entries.append((stem, key))
+        cached_paths = [_cache_path(cache_folder, key, extension) for extension in GROUND_TRUTH_CACHE_EXTENSIONS]
+        if all(os.path.exists(path) for path in cached_paths):
+            # Copied, not linked: if make rebuilds a file anyway it truncates
+            # it in place, which must not touch the cache. .box is restored
+            # before .lstmf and both are newer than the inputs, so make treats
+            # them as up to date.
+            for extension, cached_path in zip(GROUND_TRUTH_CACHE_EXTENSIONS, cached_paths):
+                os.utime(cached_path)
+                restored_path = os.path.join(ground_truth_dir, stem + extension)
+                shutil.copyfile(cached_path, restored_path)
+            reused += 1
+    return entries, reused
+
+
+def harvest_ground_truth(username, entries, ground_truth_dir):
+    """Add .box/.lstmf files generated by the job to the cache. Returns the number added.
+
+    Only call this when make got past the .lstmf files; empty files are
+    left out all the same.
+    """
+    cache_folder = generate_ground_truth_cache_folder(username)
+    added = 0
+    for (stem, key) in entries:
+        generated_paths = [os.path.join(ground_truth_dir, stem + extension) for extension in GROUND_TRUTH_CACHE_EXTENSIONS]
+        if not all(os.path.isfile(path) and os.path.getsize(path) > 0 for path in generated_paths):
+            continue
+        for extension, generated_path in zip(GROUND_TRUTH_CACHE_EXTENSIONS, generated_paths):
+            cached_path = _cache_path(cache_folder, key, extension)
+            if os.path.exists(cached_path):
+                continue
+            helpers.create_folder_if_not_exists(os.path.dirname(cached_path))
+            temp_path = cached_path + '.tmp%s' % os.getpid()
+            link_or_copy(generated_path, temp_path)
+            os.replace(temp_path, cached_path)
+            added += 1
+    prune_ground_truth_cache(cache_folder)
+    return added
+
+
+def prune_ground_truth_cache(cache_folder, max_age_days=GROUND_TRUTH_CACHE_MAX_AGE_DAYS):
+    if not os.path.isdir(cache_folder):
+        return
+    oldest_allowed = time.time() - max_age_days * 24 * 3600
+    for dirpath, _, filenames in os.walk(cache_folder):
+        for filename in filenames:
+            full_filename = os.path.join(dirpath, filename)
+            try:
+                if os.path.getmtime(full_filename) < oldest_allowed:
+                    os.remove(full_filename)
+            except OSError:
+                pass
+
+
+# make variables that change the merged unicharset and the proto model.
+START_MODEL_SETTING_KEYS = ('NORM_MODE', 'LANG_TYPE', 'LANGDATA_DIR')
+START_MODEL_CACHE_MAX_BYTES = int(os.environ.get('START_MODEL_CACHE_MAX_BYTES', 5 * 1024 ** 3))
+# Output of tesstrain's unicharset rule, relative to $(OUTPUT_DIR).
+STARTER_FILES = ('my.unicharset', 'unicharset')
+
+
+def generate_start_model_cache_folder():
+    return os.path.join(helpers.tesstrain_cache_path, 'start-models')
+
+
+def template_key(template_path):
+    """sha256 of the template file, remembered by size and mtime to avoid re-reading it."""
+    cache_folder = generate_start_model_cache_folder()
+    helpers.create_folder_if_not_exists(cache_folder)
+    index_path = os.path.join(cache_folder, 'template_hashes.json')
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+    stat = os.stat(template_path)
+    signature = [stat.st_size, stat.st_mtime_ns]
+    known = index.get(template_path)
+    if known and known[:2] == signature:
+        return known[2]
+    key = hash_file(template_path).hexdigest()
+    index[template_path] = signature + [key]
+    temp_path = index_path + '.tmp%s' % os.getpid()
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    os.replace(temp_path, index_path)
+    return key
+
+
+def charset_fingerprint(ground_truth_dir, more_parameters):
+    """Hash of the characters used by the ground truth plus the unicharset settings."""
+    characters = set()
+    for filename in os.listdir(ground_truth_dir):
+        if filename.endswith('.gt.txt'):
+            characters.update(helpers.safe_read_image_text(os.path.join(ground_truth_dir, filename)))
+    variables = parse_make_variables(more_parameters)
+    settings = ';'.join('%s=%s' % (key, variables.get(key, '')) for key in START_MODEL_SETTING_KEYS)
+    digest = hashlib.sha256(''.join(sorted(characters)).encode('utf-8'))
+    digest.update(b'\0' + settings.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _start_model_entries(template_hash, charset_hash):
+    cache_folder = generate_start_model_cache_folder()
+    components_folder = os.path.join(cache_folder, 'components_' + template_hash)
+    starter_folder = os.path.join(cache_folder, 'starter_' + template_hash + '_' + charset_hash)
+    return components_folder, starter_folder
+
+
+def _write_all_gt(ground_truth_dir, all_gt_path):
+    """Concatenate the ground truth texts the way tesstrain's all-gt rule does."""
+    with open(all_gt_path, 'wb') as all_gt:
+        for filename in sorted(os.listdir(ground_truth_dir)):
+            if filename.endswith('.gt.txt'):
+                with open(os.path.join(ground_truth_dir, filename), 'rb') as gt_file:
+                    all_gt.write(gt_file.read())
+                    all_gt.write(b'\n')
+
+
+def restore_start_model(template_path, start_template, model_name, data_dir, ground_truth_dir, more_parameters):
+    """Copy cached start model files into the job's DATA_DIR.
+
+    Returns (template hash, charset hash, restored) where restored is True
+    when make can skip unpacking the template and building the proto model.
+    """
+    if not os.path.exists(template_path):
+        return None, None, False
+    template_hash = template_key(template_path)
+    charset_hash = charset_fingerprint(ground_truth_dir, more_parameters)
+    components_folder, starter_folder = _start_model_entries(template_hash, charset_hash)
+    if not (os.path.isdir(components_folder) and os.path.isdir(starter_folder)):
+        return template_hash, charset_hash, False
+
+    output_dir = os.path.join(data_dir, model_name)
+    start_model_dir = os.path.join(data_dir, start_template)
+    helpers.create_folder_if_not_exists(output_dir)
+    helpers.create_folder_if_not_exists(start_model_dir)
+    for filename in os.listdir(components_folder):
+        # Stored as MODEL.<component>, tesstrain names them after MODEL_NAME.
+        shutil.copyfile(os.path.join(components_folder, filename),
+                        os.path.join(start_model_dir, model_name + filename[len('MODEL'):]))
+    _write_all_gt(ground_truth_dir, os.path.join(output_dir, 'all-gt'))
+    for filename in STARTER_FILES:
+        shutil.copyfile(os.path.join(starter_folder, filename), os.path.join(output_dir, filename))
+    shutil.copyfile(os.path.join(starter_folder, 'proto.traineddata'),
+                    os.path.join(output_dir, model_name + '.traineddata'))
+
+    # Each target must be newer than its prerequisites for make to skip it:
+    # ground truth < all-gt < unicharset < proto model.
+    now = time.time()
+    ordered = [os.path.join(output_dir, filename) for filename in ('all-gt',) + STARTER_FILES]
+    ordered.append(os.path.join(output_dir, model_name + '.traineddata'))
+    for offset, path in enumerate(reversed(ordered)):
+        os.utime(path, (now - offset * 0.01, now - offset * 0.01))
+    for path in (components_folder, starter_folder):
+        os.utime(path)
+    return template_hash, charset_hash, True
+
+
+def harvest_start_model(template_hash, charset_hash, start_template, model_name, data_dir, output_dir):
+    """Store the unpacked template and starter files of a finished job in the cache.
+
+    output_dir is where the job's $(OUTPUT_DIR) ended up, which is the
+    results folder once the job's mv ran.
+    """
+    components_folder, starter_folder = _start_model_entries(template_hash, charset_hash)
+    start_model_dir = os.path.join(data_dir, start_template)
+    prefix = model_name + '.'
+    if not os.path.isdir(components_folder) and os.path.isdir(start_model_dir):
+        components = [f for f in os.listdir(start_model_dir) if f.startswith(prefix)]
+        if components:
+            _store_folder(components_folder, [
+                (os.path.join(start_model_dir, f), 'MODEL' + f[len(model_name):]) for f in components
+            ])
+    starter_sources = [(os.path.join(output_dir, f), f) for f in STARTER_FILES]
+    starter_sources.append((os.path.join(output_dir, model_name + '.traineddata'), 'proto.traineddata'))
+    if not os.path.isdir(starter_folder) and all(os.path.exists(source) for source, _ in starter_sources):
+        _store_folder(starter_folder, starter_sources)
+    evict_start_model_cache()
+
+
+def _store_folder(target_folder, sources):
+    """Copy (source path, name) pairs into target_folder, appearing atomically."""
+    temp_folder = target_folder + '.tmp%s' % os.getpid()
+    shutil.rmtree(temp_folder, ignore_errors=True)
+    os.makedirs(temp_folder)
+    for source_path, name in sources:
+        shutil.copyfile(source_path, os.path.join(temp_folder, name))
+    try:
+        os.rename(temp_folder, target_folder)
+    except OSError:
+        # Another job stored the same entry first.
+        shutil.rmtree(temp_folder, ignore_errors=True)
+
+
+def _folder_size(folder):
+    total = 0
+    for dirpath, _, filenames in os.walk(folder):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass
+    return total
+
+
+def evict_start_model_cache(max_bytes=START_MODEL_CACHE_MAX_BYTES):
+    """Remove least recently used entries until the cache fits in max_bytes."""
+    cache_folder = generate_start_model_cache_folder()
+    if not os.path.isdir(cache_folder):
+        return
+    entries = []
+    for name in os.listdir(cache_folder):
+        path = os.path.join(cache_folder, name)
+        if os.path.isdir(path) and '.tmp' not in name:
+            entries.append((os.path.getmtime(path), _folder_size(path), path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        logger.info('Evicting start model cache entry %s' % path)
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent training job queue.
+
+Jobs live in the training_job table, so queued work survives a restart of the
+web server. The web app only adds and stops jobs here; the training runner
+(scripts/training_runner.py) dispatches them to a fixed number of slots: the
+user with the fewest running jobs goes first and each user's own jobs run in
+the order they were submitted.
+
+All state is kept in the database so every gunicorn worker sees the same
+answer. Status changes go through compare_and_set_status, which only updates
+a row that is still in the expected state.
+"""
+
+import datetime
+import logging
+import os
+from collections import Counter
+
+from sqlalchemy import update
+
+from scripts import helpers
+from scripts import tabledef
+
+logger = logging.getLogger('MainProgram')
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_COMPLETED = 'completed'
+STATUS_FAILED = 'failed'
+STATUS_STOPPED = 'stopped'
+
+ACTIVE_STATUSES = (STATUS_QUEUED, STATUS_RUNNING)
+
+RUNNER_STATE_ID = 1
+# The runner is considered offline when it missed heartbeats for this long.
+RUNNER_HEARTBEAT_TIMEOUT_SECONDS = 30
+
+
+def get_configured_slot_count():
+    """Number of jobs this host may run at once.
+
+    TRAINING_SLOTS overrides the default, which is one slot per
+    TRAINING_CORES_PER_JOB cores (1 unless configured).
+    """
+    configured = os.environ.get('TRAINING_SLOTS', '').strip()
+    if configured:
+        try:
+            return max(1, int(configured))
+        except ValueError:
+            logger.warning('Ignoring invalid TRAINING_SLOTS value: %s' % configured)
+    try:
+        cores_per_job = max(1, int(os.environ.get('TRAINING_CORES_PER_JOB', '1')))
+    except ValueError:
+        cores_per_job = 1
+    return max(1, (os.cpu_count() or 1) // cores_per_job)
+
+
+def get_slot_count():
+    """Slot count published by the running runner, or the local configuration."""
+    runner_state = get_runner_state()
+    if runner_state and runner_state.slot_count:
+        return runner_state.slot_count
+    return get_configured_slot_count()
+
+
+def get_runner_state():
+    with helpers.session_scope() as s:
+        return s.query(tabledef.TrainingRunner).filter_by(id=RUNNER_STATE_ID).first()
+
+
+def is_runner_online(runner_state=None):
+    runner_state = runner_state or get_runner_state()
+    if not runner_state or not runner_state.heartbeat_at:
+        return False
+    age = (datetime.datetime.now() - runner_state.heartbeat_at).total_seconds()
+    return age <= RUNNER_HEARTBEAT_TIMEOUT_SECONDS
+
+
+def publish_runner_state(pid, hostname, slot_count, started_at):
+    """Insert or refresh the runner row; called by the runner holding the lock."""
+    now = datetime.datetime.now()
+    with helpers.session_scope() as s:
+        runner_state = s.query(tabledef.TrainingRunner).filter_by(id=RUNNER_STATE_ID).first()
+        if runner_state is None:
+            runner_state = tabledef.TrainingRunner(id=RUNNER_STATE_ID)
+            s.add(runner_state)
+        runner_state.pid = pid
+        runner_state.hostname = hostname
+        runner_state.slot_count = slot_count
+        runner_state.started_at = started_at
+        runner_state.heartbeat_at = now
+        s.commit()
+
+
+def enqueue_job(username, model_name, start_template, more_parameters, continue_from='', replay_percent=None,
+                early_stop_checkpoints=None):
+    """Store a new queued job and return it (detached from the session).
+
+    continue_from names a previous result to fine-tune incrementally, see
+    incremental_training. With early_stop_checkpoints the runner ends the
+    training after that many checkpoints without a better BCER.
+    """
+    (logfilename, log_filename_only) = helpers.get_current_log_name(username)
+    with helpers.session_scope() as s:
+        job = tabledef.TrainingJob(
+            username=username,
+            model_name=model_name,
+            start_template=start_template,
+            more_parameters=more_parameters,
+            continue_from=continue_from or None,
+            replay_percent=replay_percent,
+            early_stop_checkpoints=early_stop_checkpoints,
+            log_filename=logfilename,
+            status=STATUS_QUEUED,
+            created_at=datetime.datetime.now()
+        )
+        s.add(job)
+        s.commit()
+    position = get_queue_position(job.id)
+    with open(logfilename, 'a', encoding='utf-8') as the_logfile:
+        the_logfile.write('Training job %s queued for %s, position in queue: %s\n' % (job.id, model_name, position))
+    logger.info('%s queued training job %s (%s)' % (username, job.id, model_name))
+    return job
+
+
+def get_job(job_id):
+    with helpers.session_scope() as s:
+        return s.query(tabledef.TrainingJob).filter_by(id=job_id).first()
+
+
+def list_jobs(statuses):
+    with helpers.session_scope() as s:
+        return s.query(tabledef.TrainingJob).filter(
+            tabledef.TrainingJob.status.in_(statuses)
+        ).order_by(tabledef.TrainingJob.created_at.asc(), tabledef.TrainingJob.id.asc()).all()
+
+
+def get_running_jobs():
+    return list_jobs([STATUS_RUNNING])
+
+
+def get_queued_jobs():
+    return list_jobs([STATUS_QUEUED])
+
+
+def get_queue_position(job_id):
+    """1-based position of a queued job in dispatch order, None if not queued."""
+    queued = get_queued_jobs()
+    running = get_running_jobs()
+    position = 1
+    while queued:
+        next_job = select_next_job(queued, running)
+        if next_job.id == job_id:
+            return position
+        queued.remove(next_job)
+        running.append(next_job)
+        position += 1
+    return None
+
+
+def select_next_job(queued_jobs, running_jobs):
+    """Fair-share pick: fewest running jobs per user first, then oldest job.
+
+    Only the oldest queued job of every user is a candidate, which keeps each
+    user's jobs in FIFO order.
+    """
+    if not queued_jobs:
+        return None
+    running_per_user = Counter(job.username for job in running_jobs)
+    oldest_per_user = {}
+    for job in sorted(queued_jobs, key=lambda j: (j.created_at, j.id)):
+        oldest_per_user.setdefault(job.username, job)
+    return min(
+        oldest_per_user.values(),
+        key=lambda j: (running_per_user[j.username], j.created_at, j.id)
+    )
+
+
+def compare_and_set_status(job_id, expected_statuses, new_status, **values):
+    """Atomically move a job to new_status if it is still in one of expected_statuses.
+
+    Returns True when this call made the change, False when another worker or
+    the runner changed the job first.
+    """
+    with helpers.session_scope() as s:
+        result = s.execute(
+            update(tabledef.TrainingJob)
+            .where(tabledef.TrainingJob.id == job_id)
+            .where(tabledef.TrainingJob.status.in_(list(expected_statuses)))
+            .values(status=new_status, **values)
+        )
+        s.commit()
+        return result.rowcount == 1
+
+
+def claim_job(job_id, runner_pid):
+    """Move a job from queued to running. False if somebody else got it."""
+    return compare_and_set_status(
+        job_id, [STATUS_QUEUED], STATUS_RUNNING,
+        started_at=datetime.datetime.now(), runner_pid=runner_pid
+    )
+
+
+def finish_job(job_id, status, message=''):
+    """Record the final state of a running job; a job stopped meanwhile keeps its state."""
+    return compare_and_set_status(
+        job_id, [STATUS_RUNNING], status,
+        message=message, finished_at=datetime.datetime.now()
+    )
+
+
+def record_job_process(job_id, process_pid, process_group_id):
+    """Remember the training process of a job so it can be killed later; None once it exited."""
+    with helpers.session_scope() as s:
+        s.execute(
+            update(tabledef.TrainingJob)
+            .where(tabledef.TrainingJob.id == job_id)
+            .values(process_pid=process_pid, process_group_id=process_group_id)
+        )
+        s.commit()
+
+
+def stop_job(job_id):
+    """Mark a queued or running job as stopped so its slot is given to the next job.
+
+    The runner sees the new state and terminates the training process of a
+    running job.
+    """
+    return compare_and_set_status(
+        job_id, ACTIVE_STATUSES, STATUS_STOPPED,
+        finished_at=datetime.datetime.now()
+    )
+
+
+def is_stop_requested(job_id):
+    job = get_job(job_id)
+    return job is None or job.status == STATUS_STOPPED
+
+
+def set_stopped_message(job_id, message):
+    """Record how a stopped job ended; the job stays stopped."""
+    return compare_and_set_status(job_id, [STATUS_STOPPED], STATUS_STOPPED, message=message)
+
+
+def recover_interrupted_jobs():
+    """Fail running jobs of a previous runner; queued jobs are kept as they are.
+
+    Only the runner holding the runner lock calls this, when it starts, so
+    every running job is an orphan whatever runner_pid it has (after a
+    restart the number may be the new runner's, or an unrelated process').
+    Returns the orphaned jobs that still have a training process recorded,
+    including jobs stopped while no runner was there to kill their process.
+    """
+    orphans = []
+    for job in list_jobs([STATUS_RUNNING, STATUS_STOPPED]):
+        if job.status == STATUS_RUNNING:
+            logger.warning('Training job %s was interrupted (runner %s is gone)' % (job.id, job.runner_pid))
+            finish_job(job.id, STATUS_FAILED, 'Interrupted by a server restart')
+        if job.process_group_id:
+            orphans.append(job)
+    return orphans
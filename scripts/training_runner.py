@@ -0,0 +1,564 @@
+# -*- coding: utf-8 -*-
+"""
+Training runner daemon.
+
+Run it next to the web server with:
+
+    python -m scripts.training_runner
+
+It is the only process that starts tesstrain. It polls the training_job table
+for queued jobs, runs them in the available slots and writes their state back
+to the table, so the web workers stay short-lived and never own a training.
+
+A lock file makes sure only one runner owns the queue; a second runner waits
+until the first one exits. The runner publishes a heartbeat row
+(training_runner) that the web workers use to show its state.
+
+Every training command runs in its own process group. When a job is stopped
+from the web app, or the runner shuts down, the whole group gets SIGTERM and,
+if it is still there after STOP_GRACE_SECONDS, SIGKILL.
+"""
+
+import argparse
+import datetime
+import fcntl
+import logging
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import time
+from threading import Event, Thread
+
+from scripts import helpers
+from scripts import incremental_training
+from scripts import log_archive
+from scripts import queue_logging
+from scripts import training_cache
+from scripts import training_queue
+from scripts import training_telemetry
+
+logger = logging.getLogger('MainProgram')
+
+runner_log_file_path = '/var/log/tesseracttraining/training_runner.log'
+runner_lock_file_path = '/var/www/tesseracttraining/training_runner.lock'
+
+POLL_INTERVAL_SECONDS = 2
+# Time a stopped training gets to exit after SIGTERM before it is killed.
+STOP_GRACE_SECONDS = 20
+# How often finished logs are looked for and archived.
+ARCHIVE_CHECK_SECONDS = 300
+
+_wakeup = Event()
+_shutdown = Event()
+_job_threads = []
+_archive_thread = None
+
+
+def acquire_lock_file(lock_file_path, description):
+    """Take an exclusive flock on lock_file_path, waiting if somebody else has it.
+
+    The returned file object holds the lock until it is closed.
+    """
+    lock_file = open(lock_file_path, 'a+')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        logger.info('Waiting for %s (%s is locked)' % (description, lock_file_path))
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+    lock_file.seek(0)
+    lock_file.truncate()
+    lock_file.write(str(os.getpid()))
+    lock_file.flush()
+    return lock_file
+
+
+def prepare_result_folder(job):
+    """Move a previous result with the same model name aside, as a timestamped copy."""
+    result_dir = helpers.generate_result_folder(job.username, 'results')
+    helpers.create_folder_if_not_exists(result_dir)
+    result_dir_model = os.path.join(result_dir, job.model_name)
+    if os.path.exists(result_dir_model):
+        new_path = result_dir_model + '_' + datetime.datetime.utcnow().strftime('%Y%m%d_%H%M%S%f')
+        shutil.move(result_dir_model, new_path)
+    if os.path.exists(result_dir_model + '.traineddata'):
+        new_path_2 = result_dir_model + '.traineddata' + '_' + datetime.datetime.utcnow().strftime('%Y%m%d_%H%M%S%f')
+        shutil.move(result_dir_model + '.traineddata', new_path_2)
+    return result_dir
+
+
+def prepare_job_folder(job):
+    """Create an empty data and scratch folder for the job, removing leftovers."""
+    remove_job_folder(job.id)
+    helpers.create_folder_if_not_exists(helpers.generate_job_data_folder(job.id))
+    helpers.create_folder_if_not_exists(helpers.generate_job_scratch_folder(job.id))
+
+
+def remove_job_folder(job_id):
+    job_folder = helpers.generate_job_folder(job_id)
+    if os.path.isdir(job_folder):
+        shutil.rmtree(job_folder, ignore_errors=True)
+
+
+def remove_stale_job_folders():
+    """Remove job folders left behind by jobs that are no longer running."""
+    if not os.path.isdir(helpers.tesstrain_jobs_path):
+        return
+    running_folders = set(os.path.basename(helpers.generate_job_folder(job.id)) for job in training_queue.get_running_jobs())
+    for folder_name in os.listdir(helpers.tesstrain_jobs_path):
+        if folder_name.startswith('job_') and folder_name not in running_folders:
+            logger.info('Removing stale job folder %s' % folder_name)
+            shutil.rmtree(os.path.join(helpers.tesstrain_jobs_path, folder_name), ignore_errors=True)
+
+
+def get_start_model(job, previous=None):
+    """(TESSDATA folder, START_MODEL) of the job; a previous result lives in the job's own tessdata."""
+    if previous:
+        return helpers.generate_job_tessdata_folder(job.id), previous['start_model']
+    return helpers.tesstrain_tessdata_path, job.start_template or ''
+
+
+def link_base_tessdata(job):
+    """Make the stock tessdata files visible next to the previous result."""
+    tessdata_dir = helpers.generate_job_tessdata_folder(job.id)
+    helpers.create_folder_if_not_exists(tessdata_dir)
+    if not os.path.isdir(helpers.tesstrain_tessdata_path):
+        return
+    for name in os.listdir(helpers.tesstrain_tessdata_path):
+        target = os.path.join(tessdata_dir, name)
+        if not os.path.exists(target):
+            os.symlink(os.path.join(helpers.tesstrain_tessdata_path, name), target)
+
+
+def build_result_move_command(job):
+    result_dir = helpers.generate_result_folder(job.username, 'results')
+    data_dir = helpers.generate_job_data_folder(job.id)
+    copy_command_1 = 'mv -v %s %s' % (os.path.join(data_dir, job.model_name), result_dir)
+    copy_command_2 = 'mv -v %s.traineddata %s' % (os.path.join(data_dir, job.model_name), result_dir)
+    return copy_command_1 + ' &&  ' + copy_command_2
+
+
+def build_training_command(job, previous=None):
+    ground_truth_dir = helpers.generate_job_ground_truth_folder(job.id)
+    data_dir = helpers.generate_job_data_folder(job.id)
+    (tessdata_dir, start_model) = get_start_model(job, previous)
+    start_model_string = ''
+    if start_model:
+        start_model_string = ' START_MODEL=' + start_model
+    conversion_command = incremental_training.build_checkpoint_conversion_command(previous)
+    if conversion_command:
+        conversion_command += ' && '
+    return 'cd %s  && ' % helpers.tesstrain_path + conversion_command \
+        + 'make training TESSDATA=%s DATA_DIR=%s MODEL_NAME=%s %s GROUND_TRUTH_DIR=%s %s' % (
+            tessdata_dir, data_dir,
+            job.model_name, start_model_string, ground_truth_dir, job.more_parameters or '') \
+        + ' && ' + build_result_move_command(job)
+
+
+def find_best_checkpoint(job):
+    """Checkpoint with the lowest BCER, the last checkpoint if there is none, or None.
+
+    lstmtraining names best models <model>_<BCER>_<iteration>_<iteration>.checkpoint.
+    """
+    checkpoint_dir = os.path.join(helpers.generate_job_data_folder(job.id), job.model_name, 'checkpoints')
+    if not os.path.isdir(checkpoint_dir):
+        return None
+    best = None
+    prefix = job.model_name + '_'
+    for name in os.listdir(checkpoint_dir):
+        if not (name.startswith(prefix) and name.endswith('.checkpoint')):
+            continue
+        parts = name[len(prefix):-len('.checkpoint')].split('_')
+        try:
+            rank = (float(parts[0]), -int(parts[1]))
+        except (ValueError, IndexError):
+            continue
+        if best is None or rank < best[0]:
+            best = (rank, name)
+    if best:
+        return os.path.join(checkpoint_dir, best[1])
+    last_checkpoint = os.path.join(checkpoint_dir, job.model_name + '_checkpoint')
+    if os.path.isfile(last_checkpoint):
+        return last_checkpoint
+    return None
+
+
+def build_finalize_command(job, checkpoint):
+    """Build <model>.traineddata from a checkpoint of an early stopped training and move the results."""
+    data_dir = helpers.generate_job_data_folder(job.id)
+    proto_model = os.path.join(data_dir, job.model_name, job.model_name + '.traineddata')
+    return 'cd %s  && ' % helpers.tesstrain_path \
+        + 'lstmtraining --stop_training --continue_from %s --traineddata %s --model_output %s.traineddata' % (
+            checkpoint, proto_model, os.path.join(data_dir, job.model_name)) \
+        + ' && ' + build_result_move_command(job)
+
+
+def restore_start_model(job, previous=None):
+    (tessdata_dir, start_model) = get_start_model(job, previous)
+    template_path = os.path.join(tessdata_dir, start_model + '.traineddata')
+    return training_cache.restore_start_model(
+        template_path, start_model, job.model_name, helpers.generate_job_data_folder(job.id),
+        helpers.generate_job_ground_truth_folder(job.id), job.more_parameters)
+
+
+def harvest_start_model(job, start_model_cache, previous=None):
+    """Cache the start model files; after a successful job they are in the results folder."""
+    (template_hash, charset_hash, _) = start_model_cache
+    (_, start_model) = get_start_model(job, previous)
+    data_dir = helpers.generate_job_data_folder(job.id)
+    output_dir = os.path.join(data_dir, job.model_name)
+    if not os.path.isdir(output_dir):
+        output_dir = os.path.join(helpers.generate_result_folder(job.username, 'results'), job.model_name)
+    training_cache.harvest_start_model(template_hash, charset_hash, start_model, job.model_name, data_dir, output_dir)
+
+
+def build_job_environment(job):
+    """Environment of the training command, with temporary files in the job's scratch folder."""
+    env = dict(os.environ)
+    scratch_dir = helpers.generate_job_scratch_folder(job.id)
+    env['TMPDIR'] = scratch_dir
+    env['TMP'] = scratch_dir
+    env['TEMP'] = scratch_dir
+    return env
+
+
+def _process_group_alive(process_group_id):
+    try:
+        os.killpg(process_group_id, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def terminate_process_group(process_group_id, process=None, timeout=STOP_GRACE_SECONDS):
+    """Send SIGTERM to a process group and SIGKILL when it is still there after timeout.
+
+    process is the Popen of the group leader if it is our child; it is reaped
+    while waiting. Returns the name of the signal that ended the group, or
+    None when it was already gone.
+    """
+    try:
+        os.killpg(process_group_id, signal.SIGTERM)
+    except ProcessLookupError:
+        return None
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None:
+            process.poll()
+        if not _process_group_alive(process_group_id):
+            return 'SIGTERM'
+        time.sleep(0.2)
+    try:
+        os.killpg(process_group_id, signal.SIGKILL)
+    except ProcessLookupError:
+        return 'SIGTERM'
+    if process is not None:
+        process.wait()
+    return 'SIGKILL'
+
+
+def kill_orphaned_process(job):
+    """Terminate the training left behind by a previous runner."""
+    process_group_id = job.process_group_id
+    try:
+        # After a reboot the number may belong to an unrelated process; the
+        # training command was started as the leader of its own session.
+        is_training = os.getsid(process_group_id) == process_group_id
+    except ProcessLookupError:
+        is_training = False
+    if is_training:
+        signal_name = terminate_process_group(process_group_id)
+        logger.warning('Training job %s: ended orphaned process group %s with %s' % (job.id, process_group_id, signal_name))
+    training_queue.record_job_process(job.id, None, None)
+
+
+def update_telemetry(job, telemetry=None):
+    try:
+        return training_telemetry.update_telemetry(job, telemetry)
+    except Exception as e:
+        logger.exception(e)
+        return None
+
+
+def wait_for_training(job, process, early_stop_checkpoints=None):
+    """Wait for the training command, ending it early when the job is stopped or the runner shuts down.
+
+    The job's telemetry is updated on every poll. With early_stop_checkpoints
+    the command is also ended after that many checkpoints without a better
+    BCER. Returns (returncode, None) when the command exited by itself,
+    otherwise (returncode, (reason, signal name, seconds it took to end))
+    with reason 'stopped', 'shutdown' or 'early_stop'.
+    """
+    telemetry = None
+    while True:
+        try:
+            return process.wait(timeout=POLL_INTERVAL_SECONDS), None
+        except subprocess.TimeoutExpired:
+            pass
+        telemetry = update_telemetry(job, telemetry)
+        if _shutdown.is_set():
+            reason = 'shutdown'
+        elif training_queue.is_stop_requested(job.id):
+            reason = 'stopped'
+        elif early_stop_checkpoints and telemetry \
+                and training_telemetry.checkpoints_without_improvement(telemetry) >= early_stop_checkpoints:
+            reason = 'early_stop'
+        else:
+            continue
+        logger.info('Training job %s %s, terminating process group %s' % (job.id, reason, process.pid))
+        started = time.monotonic()
+        signal_name = terminate_process_group(process.pid, process)
+        return process.wait(), (reason, signal_name, time.monotonic() - started)
+
+
+def run_command(job, command_list, the_logfile, early_stop_checkpoints=None):
+    """Run one shell command of a job in its own process group, see wait_for_training."""
+    # A new session makes the shell the leader of a process group holding
+    # make, lstmtraining and everything they start.
+    p = subprocess.Popen(command_list, stdout=the_logfile, stderr=subprocess.STDOUT, shell=True,
+                         env=build_job_environment(job), start_new_session=True)
+    training_queue.record_job_process(job.id, p.pid, p.pid)
+    try:
+        result = wait_for_training(job, p, early_stop_checkpoints)
+    finally:
+        training_queue.record_job_process(job.id, None, None)
+    the_logfile.flush()
+    update_telemetry(job)
+    return result
+
+
+def run_job(job):
+    """Run one claimed job to completion and record the outcome."""
+    status = training_queue.STATUS_FAILED
+    message = ''
+    ground_truth_entries = []
+    # Only once make got past the .lstmf files; a stopped or failed job
+    # may leave half written ones.
+    ground_truth_complete = False
+    start_model_cache = None
+    previous = None
+    try:
+        with open(job.log_filename, 'a', encoding='utf-8') as the_logfile:
+            try:
+                prepare_job_folder(job)
+                if job.continue_from:
+                    # Before prepare_result_folder, which moves a result with
+                    # the same model name aside.
+                    link_base_tessdata(job)
+                    previous = incremental_training.prepare_previous_model(
+                        job.username, job.continue_from, helpers.generate_job_tessdata_folder(job.id))
+                prepare_result_folder(job)
+                pairs = helpers.list_training_pairs(job.username)
+                keyed_pairs = training_cache.ground_truth_keys(job.username, pairs, job.more_parameters)
+                if previous:
+                    replay_percent = job.replay_percent if job.replay_percent is not None else incremental_training.DEFAULT_REPLAY_PERCENT
+                    (keyed_pairs, new_count, replay_count) = incremental_training.select_incremental_pairs(
+                        keyed_pairs, previous['keys'], replay_percent, seed=job.id)
+                    the_logfile.write('Continue from %s: %s new image/text pairs, %s replayed from earlier trainings\n' % (job.continue_from, new_count, replay_count))
+                    if new_count == 0:
+                        raise Exception('No new image/text pairs since %s was trained, nothing to continue with' % job.continue_from)
+                (ground_truth_entries, reused) = training_cache.prepare_ground_truth(
+                    job.username, keyed_pairs, helpers.generate_job_ground_truth_folder(job.id))
+                the_logfile.write('Ground truth: %s image/text pairs, %s .box/.lstmf taken from cache\n' % (len(keyed_pairs), reused))
+                (_, start_model) = get_start_model(job, previous)
+                if start_model:
+                    start_model_cache = restore_start_model(job, previous)
+                    if start_model_cache[2]:
+                        the_logfile.write('Start model %s: unpacked components and proto model taken from cache\n' % start_model)
+                command_list = build_training_command(job, previous)
+                logger.info('Running training job %s: %s' % (job.id, command_list))
+                the_logfile.write(command_list + '\n\n')
+                the_logfile.flush()
+                if training_queue.is_stop_requested(job.id):
+                    status = training_queue.STATUS_STOPPED
+                    message = 'Stopped before the training command started'
+                    the_logfile.write('\n\n' + message)
+                    training_queue.set_stopped_message(job.id, message)
+                else:
+                    (returncode, ended) = run_command(job, command_list, the_logfile, job.early_stop_checkpoints)
+                    if ended and ended[0] == 'early_stop':
+                        # There are checkpoints, so lstmtraining had all .lstmf files.
+                        ground_truth_complete = True
+                        checkpoint = find_best_checkpoint(job)
+                        if not checkpoint:
+                            raise Exception('Early stopping found no checkpoint to build %s.traineddata from' % job.model_name)
+                        message = 'Stopped early after %s checkpoints without a better BCER' % job.early_stop_checkpoints
+                        finalize_command = build_finalize_command(job, checkpoint)
+                        the_logfile.write('\n\nEarly stopping: %s, building the model from %s\n%s\n' % (
+                            message, os.path.basename(checkpoint), finalize_command))
+                        the_logfile.flush()
+                        (returncode, ended) = run_command(job, finalize_command, the_logfile)
+                    if ended:
+                        (reason, signal_name, seconds) = ended
+                        if reason == 'stopped':
+                            status = training_queue.STATUS_STOPPED
+                            message = 'Stopped, training processes ended by %s after %.1f seconds' % (signal_name, seconds)
+                            training_queue.set_stopped_message(job.id, message)
+                        else:
+                            message = 'Interrupted by a runner shutdown'
+                        the_logfile.write('\n\n' + message)
+                    elif returncode == 0:
+                        status = training_queue.STATUS_COMPLETED
+                        ground_truth_complete = True
+                        trained_keys = set(key for (_, key) in ground_truth_entries)
+                        if previous:
+                            trained_keys |= previous['keys']
+                        incremental_training.write_manifest(
+                            incremental_training.manifest_path_for_result(job.username, job.model_name),
+                            trained_keys, job.continue_from or '')
+                    else:
+                        message = 'Training command exited with code %s' % returncode
+                        the_logfile.write('\n\n' + message)
+                the_logfile.write('\n\nCompleted: %s' % job.log_filename)
+            except Exception as e:
+                message = str(e)
+                the_logfile.write(message)
+                the_logfile.flush()
+                logger.exception(e)
+    except Exception as e2:
+        message = str(e2)
+        logger.exception(e2)
+    finally:
+        if ground_truth_entries and ground_truth_complete:
+            try:
+                added = training_cache.harvest_ground_truth(job.username, ground_truth_entries, helpers.generate_job_ground_truth_folder(job.id))
+                logger.info('Training job %s added %s files to the ground truth cache' % (job.id, added))
+            except Exception as e3:
+                logger.exception(e3)
+        if start_model_cache and start_model_cache[0] and not start_model_cache[2]:
+            try:
+                harvest_start_model(job, start_model_cache, previous)
+            except Exception as e4:
+                logger.exception(e4)
+        remove_job_folder(job.id)
+        training_queue.finish_job(job.id, status, message)
+        logger.info('Training job %s finished: %s %s, its slot is free (%s/%s slots busy)' % (
+            job.id, status, message, len(training_queue.get_running_jobs()), training_queue.get_configured_slot_count()))
+        _wakeup.set()
+
+
+def _start_job_thread(job):
+    thread = Thread(target=run_job, args=(job,), name='training-job-%s' % job.id, daemon=True)
+    thread.start()
+    _job_threads[:] = [t for t in _job_threads if t.is_alive()] + [thread]
+
+
+def archive_logs():
+    try:
+        active_logs = [job.log_filename for job in training_queue.list_jobs(training_queue.ACTIVE_STATUSES)]
+        log_archive.archive_finished_logs(active_logs)
+    except Exception as e:
+        logger.exception(e)
+
+
+def start_log_archiving():
+    """Archive finished logs in a background thread, unless the previous run is still busy."""
+    global _archive_thread
+    if _archive_thread is None or not _archive_thread.is_alive():
+        _archive_thread = Thread(target=archive_logs, name='log-archive', daemon=True)
+        _archive_thread.start()
+
+
+def shutdown_jobs(timeout=STOP_GRACE_SECONDS + 10):
+    """Terminate the running trainings and wait until their jobs are recorded as failed."""
+    _shutdown.set()
+    for thread in list(_job_threads):
+        thread.join(timeout)
+
+
+def _active_job_count():
+    return len([t for t in _job_threads if t.is_alive()])
+
+
+def dispatch_pending(start_job=_start_job_thread):
+    """Start queued jobs until every slot is busy. Returns the started jobs."""
+    started = []
+    slots = training_queue.get_configured_slot_count()
+    while True:
+        running = training_queue.get_running_jobs()
+        # A stopped job keeps its slot until its processes are gone.
+        if max(len(running), _active_job_count()) >= slots:
+            break
+        job = training_queue.select_next_job(training_queue.get_queued_jobs(), running)
+        if job is None:
+            break
+        if not training_queue.claim_job(job.id, os.getpid()):
+            continue
+        job = training_queue.get_job(job.id)
+        logger.info('Dispatching training job %s for %s (%s/%s slots busy)' % (job.id, job.username, len(running) + 1, slots))
+        start_job(job)
+        started.append(job)
+    return started
+
+
+def run_forever(poll_interval=POLL_INTERVAL_SECONDS, lock_file_path=runner_lock_file_path):
+    # Held for the lifetime of the process, released by the OS on exit.
+    runner_lock = acquire_lock_file(lock_file_path, 'the training runner lock')
+    pid = os.getpid()
+    hostname = socket.gethostname()
+    slot_count = training_queue.get_configured_slot_count()
+    started_at = datetime.datetime.now()
+    training_queue.publish_runner_state(pid, hostname, slot_count, started_at)
+    for job in training_queue.recover_interrupted_jobs():
+        kill_orphaned_process(job)
+    remove_stale_job_folders()
+    logger.info('Training runner %s started with %s slots' % (pid, slot_count))
+    archived_at = 0
+    while True:
+        try:
+            training_queue.publish_runner_state(pid, hostname, slot_count, started_at)
+            dispatch_pending()
+            if time.monotonic() - archived_at >= ARCHIVE_CHECK_SECONDS:
+                archived_at = time.monotonic()
+                start_log_archiving()
+        except Exception as e:
+            logger.exception(e)
+        _wakeup.wait(poll_interval)
+        _wakeup.clear()
+
+
+def setup_logging(log_file_path):
+    handlers = [logging.StreamHandler(sys.stdout)]
+    try:
+        handlers.append(queue_logging.SharedRotatingFileHandler(log_file_path))
+    except OSError as e:
+        print('Logging to stdout only, cannot open %s: %s' % (log_file_path, e))
+    queue_logging.setup_queue_logging(logger, handlers)
+    helpers.logger = logger
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run queued Tesseract training jobs')
+    parser.add_argument(
+        '--poll-interval',
+        type=float,
+        default=POLL_INTERVAL_SECONDS,
+        help='Seconds between checks for new jobs (default: %s)' % POLL_INTERVAL_SECONDS
+    )
+    parser.add_argument(
+        '--lock-file',
+        default=runner_lock_file_path,
+        help='Lock file that allows only one runner (default: %s)' % runner_lock_file_path
+    )
+    parser.add_argument(
+        '--log-file',
+        default=runner_log_file_path,
+        help='Runner log file (default: %s)' % runner_log_file_path
+    )
+    args = parser.parse_args()
+    setup_logging(args.log_file)
+    # systemctl stop sends SIGTERM; handle it like Ctrl+C.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        run_forever(args.poll_interval, args.lock_file)
+    except KeyboardInterrupt:
+        shutdown_jobs()
+        logger.info('Training runner stopped')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Training telemetry parsed from the job logs.
+
+While a job runs, the training runner follows its log and turns the
+lstmtraining progress lines into a compact time series, kept per job in
+<user>/telemetry/job_<id>.json:
+
+    At iteration 14615/695400/698614, mean rms=0.158%, delta=0.295%,
+    BCER train=1.135%, BWER train=3.315%, skip ratio=0.4%,
+    New best BCER = 1.135 wrote checkpoint.
+
+becomes one row of "points" (see POINT_COLUMNS) plus a "checkpoint" event.
+The web app serves the file as JSON and as batched server-sent events, so
+clients do not have to read the log itself.
+"""
+
+import json
+import logging
+import os
+import re
+import time
+
+from scripts import helpers
+
+logger = logging.getLogger('MainProgram')
+
+POINT_COLUMNS = ('time', 'iteration', 'training_iteration', 'bcer', 'bwer', 'rms', 'delta', 'learning_rate')
+# Older points are thinned out when a series grows beyond this, older
+# events are dropped.
+MAX_POINTS = 2000
+MAX_EVENTS = 500
+# Bytes parsed per update; the rest follows on the next one.
+MAX_READ_BYTES = 4 * 1024 * 1024
+# Highest early stop patience a job may ask for, in checkpoints.
+MAX_EARLY_STOP_CHECKPOINTS = 1000
+
+_number = r'([-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?)'
+_iteration_re = re.compile(
+    r'At iteration (\d+)/(\d+)/(\d+), mean rms=' + _number + r'%, delta=' + _number + r'%, '
+    r'(?:BCER|char) train=' + _number + r'%, (?:BWER|word) train=' + _number + r'%', re.IGNORECASE)
+_learning_rate_re = re.compile(r'learning rate = ' + _number, re.IGNORECASE)
+_learning_rate_change_re = re.compile(r'Layer \d+=\S+: lr ' + _number + r'->' + _number)
+_new_best_re = re.compile(r'New best (?:BCER|char error) = ' + _number, re.IGNORECASE)
+_best_model_re = re.compile(r'wrote best model:\s*(\S+)')
+_finished_re = re.compile(r'Finished! .*?= ' + _number)
+_early_stop_re = re.compile(r'^Early stopping: ')
+
+
+def generate_telemetry_path(username, job_id):
+    return os.path.join(helpers.generate_result_folder(username, 'telemetry'), 'job_%s.json' % job_id)
+
+
+def new_telemetry(job_id):
+    return {
+        'job_id': job_id,
+        'offset': 0,
+        'updated_at': None,
+        'columns': list(POINT_COLUMNS),
+        'points': [],
+        'events': [],
+        'summary': {
+            'iteration': None,
+            'bcer': None,
+            'bwer': None,
+            'best_bcer': None,
+            # Iteration of the last new best BCER, and checkpoints written after it.
+            'best_iteration': None,
+            'checkpoints_since_best': 0,
+            'learning_rate': None,
+            'checkpoints': 0,
+            'finished': False,
+        },
+    }
+
+
+def read_telemetry(path):
+    """Stored telemetry, or None when the job has none (yet)."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_telemetry(path, telemetry):
+    """Replace the file in one step so readers never see half of it."""
+    helpers.create_folder_if_not_exists(os.path.dirname(path))
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(telemetry, f, separators=(',', ':'))
+    os.replace(temp_path, path)
+
+
+def _thin_points(points):
+    """Drop every second point of the older half, keeping the series under MAX_POINTS."""
+    if len(points) <= MAX_POINTS:
+        return points
+    half = len(points) // 2
+    return points[:half:2] + points[half:]
+
+
+def parse_line(telemetry, line, now):
+    """Add what one log line tells to telemetry. Returns True if anything changed."""
+    summary = telemetry['summary']
+    changed = False
+    match = _iteration_re.search(line)
+    if match:
+        (iteration, training_iteration) = (int(match.group(1)), int(match.group(2)))
+        (rms, delta, bcer, bwer) = (float(match.group(4)), float(match.group(5)), float(match.group(6)), float(match.group(7)))
+        telemetry['points'].append([now, iteration, training_iteration, bcer, bwer, rms, delta, summary['learning_rate']])
+        telemetry['points'] = _thin_points(telemetry['points'])
+        summary.update(iteration=iteration, bcer=bcer, bwer=bwer)
+        changed = True
+    match = _new_best_re.search(line)
+    if match:
+        best = float(match.group(1))
+        if summary['best_bcer'] is None or best < summary['best_bcer']:
+            summary['best_bcer'] = best
+        summary.update(best_iteration=summary['iteration'], checkpoints_since_best=0)
+        telemetry['events'].append({'time': now, 'iteration': summary['iteration'], 'type': 'new_best', 'value': best})
+        changed = True
+    if 'wrote checkpoint' in line:
+        summary['checkpoints'] += 1
+        if summary['best_iteration'] is not None and (summary['iteration'] or 0) > summary['best_iteration']:
+            summary['checkpoints_since_best'] += 1
+        telemetry['events'].append({'time': now, 'iteration': summary['iteration'], 'type': 'checkpoint'})
+        changed = True
+    match = _best_model_re.search(line)
+    if match:
+        telemetry['events'].append({'time': now, 'iteration': summary['iteration'], 'type': 'best_model', 'value': os.path.basename(match.group(1))})
+        changed = True
+    match = _learning_rate_change_re.search(line) or _learning_rate_re.search(line)
+    if match:
+        summary['learning_rate'] = float(match.group(match.lastindex))
+        telemetry['events'].append({'time': now, 'iteration': summary['iteration'], 'type': 'learning_rate', 'value': summary['learning_rate']})
+        changed = True
+    match = _finished_re.search(line)
+    if match:
+        summary['finished'] = True
+        telemetry['events'].append({'time': now, 'iteration': summary['iteration'], 'type': 'finished', 'value': float(match.group(1))})
+        changed = True
+    if _early_stop_re.search(line):
+        telemetry['events'].append({'time': now, 'iteration': summary['iteration'], 'type': 'early_stop'})
+        changed = True
+    return changed
+
+
+def update_telemetry(job, telemetry=None):
+    """Parse the part of the job log written since the last call; called by the runner.
+
+    telemetry is the result of the last call, else the job's file is read.
+    The file is only written when a line changed the points or events, so
+    pass the result back in to not parse the lines in between again.
+    """
+    path = generate_telemetry_path(job.username, job.id)
+    if telemetry is None:
+        telemetry = read_telemetry(path) or new_telemetry(job.id)
+    try:
+        with open(job.log_filename, 'rb') as f:
+            f.seek(telemetry['offset'])
+            data = f.read(MAX_READ_BYTES)
+    except OSError:
+        return telemetry
+    # An unfinished last line is parsed once it is complete.
+    end = data.rfind(b'\n') + 1
+    if end == 0:
+        return telemetry
+    now = int(time.time())
+    changed = False
+    for line in data[:end].decode('utf-8', errors='replace').splitlines():
+        changed = parse_line(telemetry, line, now) or changed
+    telemetry['offset'] += end
+    telemetry['events'] = telemetry['events'][-MAX_EVENTS:]
+    if changed or telemetry['updated_at'] is None:
+        telemetry['updated_at'] = now
+        write_telemetry(path, telemetry)
+    return telemetry
+
+
+def checkpoints_without_improvement(telemetry):
+    """Checkpoints written after the one with the best BCER; 0 before there is a best one.
+
+    Counted in the summary, as the events of that checkpoint may be dropped
+    already (MAX_EVENTS).
+    """
+    return telemetry['summary'].get('checkpoints_since_best', 0)
+
+
+def select_since(telemetry, after_iteration=None):
+    """Copy of telemetry with only the points and events after after_iteration."""
+    if after_iteration is None:
+        return telemetry
+    selected = dict(telemetry)
+    selected['points'] = [p for p in telemetry['points'] if p[1] > after_iteration]
+    # Events before the first point were part of the response that gave the
+    # client its first point.
+    selected['events'] = [e for e in telemetry['events'] if e['iteration'] is not None and e['iteration'] > after_iteration]
+    return selected